@@ -1,13 +1,26 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, Response, stream_with_context, g, has_app_context, make_response
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import google.generativeai as genai
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import markdown
 import json
 import sys
 import jinja2
+import hashlib
+import itertools
+import math
+import mmap
+import queue
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import event, func, inspect as sa_inspect, text, update
+from sqlalchemy.orm import load_only
 
 # UTF-8 인코딩 설정
 if sys.platform.startswith('win'):
@@ -17,71 +30,290 @@ if sys.platform.startswith('win'):
 # Load environment variables
 load_dotenv()
 
-# AI 설정 값
-AI_TIMEOUT = int(os.getenv("AI_TIMEOUT", "300"))  # 기본 타임아웃 300초로 증가
-AI_SAFETY_SETTINGS = os.getenv("AI_SAFETY_SETTINGS", "off")  # 기본 검열 수준을 off로 설정
-AI_TEMPERATURE = float(os.getenv("AI_TEMPERATURE", "0.7"))  # 기본 온도 설정
-AI_TOP_P = float(os.getenv("AI_TOP_P", "0.9"))  # 기본 top_p 설정
+# AI 설정 값 (환경 변수는 공유 저장소를 처음 만들거나 .env 가 바뀌었을 때의 초기값으로 사용)
+def _env_ai_settings():
+    return {
+        'timeout': int(os.getenv("AI_TIMEOUT", "300")),  # 기본 타임아웃 300초로 증가
+        'safety_settings': os.getenv("AI_SAFETY_SETTINGS", "off"),  # 기본 검열 수준을 off로 설정
+        'temperature': float(os.getenv("AI_TEMPERATURE", "0.7")),  # 기본 온도 설정
+        'top_p': float(os.getenv("AI_TOP_P", "0.9")),  # 기본 top_p 설정
+    }
+
+def parse_api_keys(value):
+    # 쉼표로 구분된 API 키 목록을 배열로 변환 (공백 제거 및 빈 키 필터링)
+    return [key.strip() for key in (value or '').split(',') if key.strip()]
+
+# 429 (할당량 초과) 오류가 난 API 키를 쉬게 하는 시간
+AI_KEY_COOLDOWN_SECONDS = float(os.getenv("AI_KEY_COOLDOWN_SECONDS", "60"))
+
+# 공유 상태 변경 여부를 DB에서 다시 확인하는 간격 (초)
+SHARED_STATE_CHECK_INTERVAL = float(os.getenv("SHARED_STATE_CHECK_INTERVAL", "1"))
+
+# 백그라운드 요약 설정 (유휴 시간에 빠지거나 오래된 회차 요약을 미리 생성)
+AI_BACKGROUND_SUMMARY = os.getenv("AI_BACKGROUND_SUMMARY", "on")  # on / off
+AI_BACKGROUND_IDLE_SECONDS = float(os.getenv("AI_BACKGROUND_IDLE_SECONDS", "3"))  # 마지막 AI 요청 후 대기 시간
+AI_BACKGROUND_WINDOW = int(os.getenv("AI_BACKGROUND_WINDOW", "5"))  # 작품을 열 때 미리 요약할 최신 회차 수
+AI_BACKGROUND_CALLS_PER_KEY = int(os.getenv("AI_BACKGROUND_CALLS_PER_KEY", "5"))  # API 키당 분당 백그라운드 호출 수
+
+# 여러 후보 동시 생성 시 최대 후보 수
+AI_MAX_CANDIDATES = int(os.getenv("AI_MAX_CANDIDATES", "4"))
+
+# 프롬프트 미리보기에서 경고할 예상 토큰 수
+AI_PROMPT_WARN_TOKENS = int(os.getenv("AI_PROMPT_WARN_TOKENS", "200000"))
+
+# AI 요청 입장 제어 (워커 프로세스마다 따로 적용)
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "8"))  # 동시에 실행할 AI 요청 수 (후보 생성은 후보 수만큼 차지)
+AI_INTERACTIVE_RESERVED = int(os.getenv("AI_INTERACTIVE_RESERVED", "2"))  # 채팅/맞춤법 검사용으로 비워 둘 자리
+AI_BATCH_MAX = int(os.getenv("AI_BATCH_MAX", "2"))  # 대요약본 생성 동시 실행 수
+AI_MAX_PER_USER = int(os.getenv("AI_MAX_PER_USER", "4"))  # 사용자(IP)별 실행 + 대기 중인 요청 수
+AI_MAX_PER_NOVEL = int(os.getenv("AI_MAX_PER_NOVEL", "4"))  # 작품별 실행 + 대기 중인 요청 수
+AI_QUEUE_LIMITS = {'interactive': 16, 'standard': 8, 'batch': 2, 'background': 0}  # 우선순위별 대기열 길이
+AI_QUEUE_MAX_WAIT = float(os.getenv("AI_QUEUE_MAX_WAIT", "30"))  # 대기열에서 기다리는 최대 시간 (초)
+AI_INTERACTIVE_DEADLINE = float(os.getenv("AI_INTERACTIVE_DEADLINE", "60"))  # 채팅/맞춤법 검사 처리 시한 (초)
+
+# API 키와 AI 설정은 여러 워커 프로세스가 같은 값을 보도록 DB(shared_state, api_key_state 테이블)에 저장하고,
+# 프로세스마다 버전 번호와 함께 캐시해 두었다가 버전이 바뀐 경우에만 다시 읽음
+SHARED_STATE = {
+    'version': None,
+    'checked_at': 0.0,
+    'settings': _env_ai_settings(),
+    'api_keys': parse_api_keys(os.getenv("GOOGLE_API_KEY", "")),
+    'key_states': {},  # 키 -> (유효하지 않음 여부, 쿨다운 종료 시각)
+}
+SHARED_STATE_LOCK = threading.Lock()
+SHARED_STATE_ENGINE = None  # create_app() 에서 설정
+
+def _read_shared_state(force=False):
+    engine = SHARED_STATE_ENGINE
+    now = time.time()
+    with SHARED_STATE_LOCK:
+        if engine is None or (not force and now - SHARED_STATE['checked_at'] < SHARED_STATE_CHECK_INTERVAL):
+            return SHARED_STATE
+    
+    with engine.connect() as conn:
+        version = conn.execute(text("SELECT value FROM shared_state WHERE name = 'version'")).scalar()
+        if not force and version == SHARED_STATE['version']:
+            with SHARED_STATE_LOCK:
+                SHARED_STATE['checked_at'] = now
+            return SHARED_STATE
+        settings = conn.execute(text("SELECT value FROM shared_state WHERE name = 'settings'")).scalar()
+        rows = conn.execute(text("SELECT api_key, invalid, cooldown_until FROM api_key_state ORDER BY position")).all()
+    
+    with SHARED_STATE_LOCK:
+        SHARED_STATE['version'] = version
+        SHARED_STATE['checked_at'] = now
+        if settings:
+            SHARED_STATE['settings'] = json.loads(settings)
+        SHARED_STATE['api_keys'] = [row[0] for row in rows]
+        SHARED_STATE['key_states'] = {row[0]: (bool(row[1]), row[2] or 0.0) for row in rows}
+    return SHARED_STATE
+
+def _write_shared_state(*statements):
+    # 변경과 버전 증가를 한 트랜잭션으로 처리한 뒤 이 프로세스의 캐시를 바로 갱신
+    if SHARED_STATE_ENGINE is None:
+        raise RuntimeError("create_app() 을 먼저 호출해야 합니다.")
+    with SHARED_STATE_ENGINE.begin() as conn:
+        for statement, params in statements:
+            conn.execute(text(statement), params)
+        conn.execute(text("UPDATE shared_state SET value = CAST(value AS INTEGER) + 1 WHERE name = 'version'"))
+    _read_shared_state(force=True)
+
+def init_shared_state():
+    """공유 저장소를 준비합니다. 저장소가 비어 있거나 .env 값이 바뀐 경우에만 환경 변수 값으로 덮어씁니다."""
+    global SHARED_STATE_ENGINE
+    SHARED_STATE_ENGINE = db.engine
+    
+    env_keys = parse_api_keys(os.getenv("GOOGLE_API_KEY", ""))
+    env_settings = _env_ai_settings()
+    env_seed = content_hash(json.dumps([env_keys, env_settings], sort_keys=True))
+    
+    with SHARED_STATE_ENGINE.begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO shared_state (name, value) VALUES ('version', '0')"))
+        seeded = conn.execute(text("SELECT value FROM shared_state WHERE name = 'env_seed'")).scalar()
+    
+    if seeded != env_seed:
+        _write_shared_state(
+            ("INSERT OR REPLACE INTO shared_state (name, value) VALUES ('env_seed', :value)", {'value': env_seed}),
+            *_settings_statements(env_settings),
+            *_api_key_statements(env_keys)
+        )
+    else:
+        _read_shared_state(force=True)
+
+def _settings_statements(settings):
+    return [("INSERT OR REPLACE INTO shared_state (name, value) VALUES ('settings', :value)", {'value': json.dumps(settings)})]
+
+def _api_key_statements(api_keys):
+    statements = [("DELETE FROM api_key_state", {})]
+    for position, key in enumerate(api_keys):
+        statements.append((
+            "INSERT INTO api_key_state (api_key, position, invalid, cooldown_until) VALUES (:key, :position, 0, 0)",
+            {'key': key, 'position': position}
+        ))
+    statements.append(("INSERT OR REPLACE INTO shared_state (name, value) VALUES ('api_key_index', '0')", {}))
+    return statements
 
-# API 키 관리 (여러 개의 API 키 지원)
-GOOGLE_API_KEYS = []
-api_key_env = os.getenv("GOOGLE_API_KEY", "")
-if api_key_env:
-    # 쉼표로 구분된 API 키 목록을 배열로 변환
-    GOOGLE_API_KEYS = [key.strip() for key in api_key_env.split(',') if key.strip()]
-    print(f"로드된 API 키: {len(GOOGLE_API_KEYS)}개")
-    for i, key in enumerate(GOOGLE_API_KEYS):
-        print(f"  키 {i+1}: {key[:4]}...{key[-4:] if len(key) > 8 else ''} (길이: {len(key)})")
+def get_ai_settings():
+    return dict(_read_shared_state()['settings'])
 
-# 현재 사용할 API 키의 인덱스
-CURRENT_API_KEY_INDEX = 0
+def update_ai_settings(settings):
+    _write_shared_state(*_settings_statements(settings))
 
-# 유효하지 않은 API 키 목록
-INVALID_API_KEYS = set()
+def get_api_keys():
+    return list(_read_shared_state()['api_keys'])
+
+def set_api_keys(api_keys):
+    _write_shared_state(*_api_key_statements(api_keys))
+
+def get_usable_api_keys():
+    # 유효하지 않거나 쿨다운 중인 키 제외
+    state = _read_shared_state()
+    now = time.time()
+    usable = []
+    for key in state['api_keys']:
+        invalid, cooldown_until = state['key_states'].get(key, (False, 0.0))
+        if not invalid and cooldown_until <= now:
+            usable.append(key)
+    return usable
+
+def mark_api_key_invalid(api_key):
+    _write_shared_state(("UPDATE api_key_state SET invalid = 1 WHERE api_key = :key", {'key': api_key}))
+
+def mark_api_key_cooldown(api_key, seconds=None):
+    cooldown_until = time.time() + (AI_KEY_COOLDOWN_SECONDS if seconds is None else seconds)
+    _write_shared_state(("UPDATE api_key_state SET cooldown_until = :until WHERE api_key = :key", {'key': api_key, 'until': cooldown_until}))
+
+def reset_invalid_api_keys():
+    _write_shared_state(("UPDATE api_key_state SET invalid = 0, cooldown_until = 0", {}))
+
+def _next_api_key_counter():
+    # 모든 워커가 하나의 카운터로 키를 돌아가며 사용 (버전은 올리지 않음)
+    if SHARED_STATE_ENGINE is None:
+        raise RuntimeError("create_app() 을 먼저 호출해야 합니다.")
+    with SHARED_STATE_ENGINE.begin() as conn:
+        conn.execute(text("UPDATE shared_state SET value = CAST(value AS INTEGER) + 1 WHERE name = 'api_key_index'"))
+        return int(conn.execute(text("SELECT value FROM shared_state WHERE name = 'api_key_index'")).scalar() or 1) - 1
+
+def is_invalid_key_error(error_message):
+    return "API_KEY_INVALID" in error_message or "API key not valid" in error_message
+
+def is_quota_error(error_message):
+    return "429" in error_message or "Resource has been exhausted" in error_message
+
+def mask_api_key(key):
+    if len(key) > 8:
+        return key[:4] + '*' * (len(key) - 8) + key[-4:]
+    return key
 
 # API 키 순환 함수
 def get_next_api_key():
-    global CURRENT_API_KEY_INDEX, INVALID_API_KEYS
+    api_keys = get_api_keys()
     
     # API 키가 없는 경우
-    if not GOOGLE_API_KEYS:
+    if not api_keys:
         print("API 키가 설정되지 않았습니다.")
         return None
     
-    # 모든 API 키가 유효하지 않은 경우, 유효하지 않은 키 목록 초기화
-    valid_keys = [key for key in GOOGLE_API_KEYS if key not in INVALID_API_KEYS]
-    if not valid_keys:
-        print("모든 API 키가 유효하지 않아 목록을 초기화합니다.")
-        INVALID_API_KEYS.clear()
-        valid_keys = GOOGLE_API_KEYS
-    
-    # 현재 인덱스가 범위를 벗어나면 재설정
-    if CURRENT_API_KEY_INDEX >= len(GOOGLE_API_KEYS):
-        CURRENT_API_KEY_INDEX = 0
-    
-    # 현재 API 키 가져오기
-    api_key = GOOGLE_API_KEYS[CURRENT_API_KEY_INDEX]
-    print(f"API 키 사용: 인덱스 {CURRENT_API_KEY_INDEX}, 키 길이: {len(api_key)}")
-    
-    # 다음 인덱스로 업데이트
-    CURRENT_API_KEY_INDEX = (CURRENT_API_KEY_INDEX + 1) % len(GOOGLE_API_KEYS)
+    usable_keys = get_usable_api_keys()
+    if not usable_keys:
+        state = _read_shared_state()
+        valid_keys = [key for key in api_keys if not state['key_states'].get(key, (False, 0.0))[0]]
+        if not valid_keys:
+            # 모든 API 키가 유효하지 않은 경우, 유효하지 않은 키 목록 초기화
+            print("모든 API 키가 유효하지 않아 목록을 초기화합니다.")
+            reset_invalid_api_keys()
+            valid_keys = api_keys
+        # 유효한 키가 모두 쿨다운 중이면 그대로 순환
+        usable_keys = valid_keys
+    
+    index = _next_api_key_counter() % len(usable_keys)
+    api_key = usable_keys[index]
+    print(f"API 키 사용: 인덱스 {index}, 키 길이: {len(api_key)}")
     
     return api_key
 
-# Configure Google AI API
-if GOOGLE_API_KEYS:
-    # 첫 번째 API 키로 초기 구성
-    genai.configure(api_key=GOOGLE_API_KEYS[0])
-    print(f"초기 API 키 설정 완료: 길이 {len(GOOGLE_API_KEYS[0])}")
-else:
-    print("Warning: GOOGLE_API_KEY not found in environment variables")
+# 무거운 모듈은 처음 사용할 때 불러옴 (워커/CLI 시작 시간 단축)
+_genai = None
+_markdown = None
+
+def get_genai():
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai_module
+        _genai = genai_module
+    return _genai
+
+def render_markdown(text):
+    global _markdown
+    if _markdown is None:
+        import markdown as markdown_module
+        _markdown = markdown_module
+    return _markdown.markdown(text or '')
+
+# 렌더링된 마크다운 캐시: 원문 해시 -> html
+MARKDOWN_CACHE = OrderedDict()
+MARKDOWN_CACHE_SIZE = 200
+MARKDOWN_CACHE_LOCK = threading.Lock()
+
+def render_markdown_cached(text, text_hash=None):
+    text_hash = text_hash or content_hash(text)
+    with MARKDOWN_CACHE_LOCK:
+        html = MARKDOWN_CACHE.get(text_hash)
+        if html is not None:
+            MARKDOWN_CACHE.move_to_end(text_hash)
+            return html
+    html = render_markdown(text)
+    with MARKDOWN_CACHE_LOCK:
+        MARKDOWN_CACHE[text_hash] = html
+        while len(MARKDOWN_CACHE) > MARKDOWN_CACHE_SIZE:
+            MARKDOWN_CACHE.popitem(last=False)
+    return html
+
+class IncrementalMarkdown:
+    """스트리밍 중인 텍스트를 렌더링합니다. 빈 줄로 끝난 블록은 한 번만 렌더링하고 마지막 블록만 다시 렌더링합니다."""
+    
+    def __init__(self):
+        self.text = ''
+        self.done_end = 0  # 렌더링이 끝난 부분의 끝 위치
+        self.done_html = []
+    
+    def feed(self, chunk):
+        self.text += chunk
+        boundary = self._last_boundary()
+        if boundary > self.done_end:
+            self.done_html.append(render_markdown(self.text[self.done_end:boundary]))
+            self.done_end = boundary
+        return ''.join(self.done_html) + render_markdown(self.text[self.done_end:])
+    
+    def _last_boundary(self):
+        # 코드 블록 밖의 빈 줄만 블록 경계로 사용 (마지막 줄은 아직 끝나지 않았을 수 있음)
+        boundary = position = self.done_end
+        in_fence = False
+        for line in self.text[self.done_end:].split('\n')[:-1]:
+            position += len(line) + 1
+            if line.lstrip().startswith('```'):
+                in_fence = not in_fence
+            elif not line.strip() and not in_fence:
+                boundary = position
+        return boundary
+
+def log_api_keys():
+    api_keys = get_api_keys()
+    if api_keys:
+        print(f"로드된 API 키: {len(api_keys)}개")
+        for i, key in enumerate(api_keys):
+            print(f"  키 {i+1}: {key[:4]}...{key[-4:] if len(key) > 8 else ''} (길이: {len(key)})")
+    else:
+        print("Warning: GOOGLE_API_KEY not found in environment variables")
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret_key'  # Add secret key for session
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///geulmeok9.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", 'sqlite:///geulmeok9.db')  # 벤치마크 등에서 다른 DB 사용 가능
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # 한글 처리를 위한 JSON 인코딩 설정
 app.config['JSON_AS_ASCII'] = False
+# 회차 본문 묶음 스냅샷을 저장할 폴더 (여러 워커가 함께 사용)
+app.config['CHAPTER_SNAPSHOT_DIR'] = os.getenv("CHAPTER_SNAPSHOT_DIR", os.path.join(app.instance_path, 'snapshots'))
 
 # nl2br 필터 추가
 @app.template_filter('nl2br')
@@ -90,7 +322,13 @@ def nl2br_filter(text):
         return jinja2.utils.markupsafe.Markup(text.replace('\n', '<br>'))
     return ''
 
-db = SQLAlchemy(app)
+# markdown 필터 추가
+@app.template_filter('markdown')
+def markdown_filter(text):
+    return jinja2.utils.markupsafe.Markup(render_markdown(text))
+
+# DB는 create_app() 에서 앱에 연결
+db = SQLAlchemy()
 
 # Database Models
 class Novel(db.Model):
@@ -103,12 +341,17 @@ class Novel(db.Model):
     settings = db.relationship('Setting', backref='novel', lazy=True, cascade="all, delete-orphan")
     prompts = db.relationship('Prompt', backref='novel', lazy=True, cascade="all, delete-orphan")
     major_summaries = db.relationship('MajorSummary', backref='novel', lazy=True, cascade="all, delete-orphan")
+    ai_responses = db.relationship('AIResponse', backref='novel', lazy=True, cascade="all, delete-orphan")
 
 class Chapter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=True)
     summary = db.Column(db.Text, nullable=True)
+    summary_hash = db.Column(db.String(40), nullable=True)  # 요약 생성 당시 본문의 해시 (본문이 바뀌면 요약이 오래된 것으로 판단)
+    content_hash = db.Column(db.String(40), nullable=True)  # 현재 본문의 해시 (저장할 때 갱신, 본문 묶음 스냅샷의 키로 사용)
+    content_tokens = db.Column(db.Integer, nullable=True)  # 본문 예상 토큰 수 (저장할 때 갱신)
+    summary_tokens = db.Column(db.Integer, nullable=True)  # 요약 예상 토큰 수 (저장할 때 갱신)
     order = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -120,6 +363,7 @@ class MajorSummary(db.Model):
     content = db.Column(db.Text)
     novel_id = db.Column(db.Integer, db.ForeignKey('novel.id'), nullable=False)
     chapter_range = db.Column(db.String(200))  # 요약에 포함된 회차 ID들을 저장 (예: "1,2,3,5,8")
+    content_tokens = db.Column(db.Integer)  # 예상 토큰 수 (저장할 때 갱신)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -127,6 +371,7 @@ class Character(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
+    description_tokens = db.Column(db.Integer)  # 예상 토큰 수 (저장할 때 갱신)
     novel_id = db.Column(db.Integer, db.ForeignKey('novel.id'), nullable=False)
     order = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -136,6 +381,7 @@ class Setting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text)
+    content_tokens = db.Column(db.Integer)  # 예상 토큰 수 (저장할 때 갱신)
     novel_id = db.Column(db.Integer, db.ForeignKey('novel.id'), nullable=False)
     order = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -150,6 +396,66 @@ class Prompt(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     novel_id = db.Column(db.Integer, db.ForeignKey('novel.id'), nullable=False)
 
+class AIResponse(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_input = db.Column(db.Text)
+    content = db.Column(db.Text)
+    content_hash = db.Column(db.String(40))  # html 을 렌더링한 원문의 해시
+    html = db.Column(db.Text)  # 렌더링된 마크다운
+    model_name = db.Column(db.String(100))
+    candidate_group = db.Column(db.String(32))  # 여러 후보 중 아직 선택되지 않은 응답의 묶음 ID
+    novel_id = db.Column(db.Integer, db.ForeignKey('novel.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SharedState(db.Model):
+    # 여러 워커가 함께 쓰는 설정 값 (version, settings, api_key_index, env_seed)
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Text)
+
+class ApiKeyState(db.Model):
+    api_key = db.Column(db.String(200), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    invalid = db.Column(db.Boolean, nullable=False, default=False)
+    cooldown_until = db.Column(db.Float, nullable=False, default=0.0)  # 429 오류 후 다시 사용할 수 있는 시각 (epoch)
+
+# 텍스트 컬럼 -> 예상 토큰 수 컬럼 (프롬프트 미리보기에서 본문을 다시 읽지 않도록 저장할 때 계산)
+TOKEN_COUNT_COLUMNS = {
+    Chapter: (('content', 'content_tokens'), ('summary', 'summary_tokens')),
+    MajorSummary: (('content', 'content_tokens'),),
+    Character: (('description', 'description_tokens'),),
+    Setting: (('content', 'content_tokens'),),
+}
+
+def estimate_tokens(text):
+    # 모델을 호출하지 않는 근사치: 영문/숫자/공백은 약 4자, 한글 등은 약 1.5자에 1토큰
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 1.5)
+
+def _update_token_counts(mapper, connection, target):
+    state = sa_inspect(target)
+    for text_attr, token_attr in TOKEN_COUNT_COLUMNS[type(target)]:
+        if text_attr in state.unloaded:
+            continue
+        missing = token_attr not in state.unloaded and getattr(target, token_attr) is None
+        if missing or state.attrs[text_attr].history.has_changes():
+            setattr(target, token_attr, estimate_tokens(getattr(target, text_attr)))
+
+for _model in TOKEN_COUNT_COLUMNS:
+    event.listen(_model, 'before_insert', _update_token_counts)
+    event.listen(_model, 'before_update', _update_token_counts)
+
+@event.listens_for(Chapter, 'before_insert')
+@event.listens_for(Chapter, 'before_update')
+def _update_chapter_hash(mapper, connection, target):
+    state = sa_inspect(target)
+    if 'content' in state.unloaded:
+        return
+    missing = 'content_hash' not in state.unloaded and target.content_hash is None
+    if missing or state.attrs['content'].history.has_changes():
+        target.content_hash = content_hash(target.content)
+
 # AI Helper functions
 def get_available_models():
     return {
@@ -157,10 +463,301 @@ def get_available_models():
         "assistant": ["gemini-2.0-flash", "gemini-2.0-flash-thinking-exp-01-21"]
     }
 
-def generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25"):
-    global INVALID_API_KEYS
+# 포그라운드 AI 요청 추적 (백그라운드 작업은 사용자의 요청이 없을 때만 실행)
+AI_FOREGROUND_ACTIVE = 0
+AI_LAST_FOREGROUND_AT = 0.0
+AI_ACTIVITY_LOCK = threading.Lock()
+
+@contextmanager
+def _foreground_ai_call():
+    global AI_FOREGROUND_ACTIVE, AI_LAST_FOREGROUND_AT
+    with AI_ACTIVITY_LOCK:
+        AI_FOREGROUND_ACTIVE += 1
+    try:
+        yield
+    finally:
+        with AI_ACTIVITY_LOCK:
+            AI_FOREGROUND_ACTIVE -= 1
+            AI_LAST_FOREGROUND_AT = time.time()
+
+class AIOverloaded(Exception):
+    """입장 제어에서 거절된 AI 요청"""
     
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    def __init__(self, priority, cost, user, novel_id, deadline, seq):
+        self.priority = priority
+        self.cost = cost
+        self.user = user
+        self.novel_id = novel_id
+        self.deadline = deadline
+        self.seq = seq
+
+class AdmissionController:
+    """AI 요청 입장 제어. 빈 자리는 우선순위(interactive > standard > batch > background)와 도착 순서대로 배정하고,
+    대기열이 가득 찼거나 사용자/작품별 한도를 넘으면 기다리지 않고 바로 거절합니다."""
+    
+    PRIORITIES = ('interactive', 'standard', 'batch', 'background')
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = Counter()  # 우선순위 -> 사용 중인 자리 수
+        self.waiting = []
+        self.in_flight_users = Counter()
+        self.in_flight_novels = Counter()
+        self.seq = itertools.count()
+    
+    def _capacity(self, priority):
+        # interactive 만 예약된 자리까지 사용할 수 있음
+        if priority == 'interactive':
+            return AI_MAX_CONCURRENT
+        if priority == 'batch':
+            return max(1, min(AI_BATCH_MAX, AI_MAX_CONCURRENT - AI_INTERACTIVE_RESERVED))
+        if priority == 'background':
+            return 1
+        return max(1, AI_MAX_CONCURRENT - AI_INTERACTIVE_RESERVED)
+    
+    def _can_run(self, ticket):
+        total = sum(self.running.values())
+        if ticket.priority == 'interactive':
+            return total + ticket.cost <= AI_MAX_CONCURRENT
+        if total + ticket.cost > max(1, AI_MAX_CONCURRENT - AI_INTERACTIVE_RESERVED):
+            return False
+        return self.running[ticket.priority] + ticket.cost <= self._capacity(ticket.priority)
+    
+    def _is_next(self, ticket):
+        # 앞선 (우선순위가 높거나 먼저 온) 대기 요청이 바로 실행될 수 있다면 양보
+        for other in sorted(self.waiting, key=lambda t: (self.PRIORITIES.index(t.priority), t.seq)):
+            if other is ticket:
+                return self._can_run(ticket)
+            if self._can_run(other):
+                return False
+        return self._can_run(ticket)
+    
+    def _leave(self, ticket):
+        self.in_flight_users[ticket.user] -= 1
+        if ticket.novel_id is not None:
+            self.in_flight_novels[ticket.novel_id] -= 1
+        # 끝난 사용자/작품은 지워서 카운터가 계속 커지지 않도록 함
+        self.in_flight_users += Counter()
+        self.in_flight_novels += Counter()
+        self.condition.notify_all()
+    
+    def acquire(self, priority, user=None, novel_id=None, cost=1, deadline=None, blocking=True):
+        """자리를 얻으면 AdmissionTicket 을 돌려주고, 얻지 못하면 AIOverloaded 를 발생시킵니다."""
+        now = time.time()
+        ticket = AdmissionTicket(priority, max(1, min(cost, self._capacity(priority))), user, novel_id, deadline, next(self.seq))
+        wait_until = now + AI_QUEUE_MAX_WAIT
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        
+        with self.condition:
+            if self.in_flight_users[user] >= AI_MAX_PER_USER:
+                raise AIOverloaded("진행 중인 AI 요청이 너무 많습니다. 이전 요청이 끝난 뒤 다시 시도해주세요.")
+            if novel_id is not None and self.in_flight_novels[novel_id] >= AI_MAX_PER_NOVEL:
+                raise AIOverloaded("이 작품에서 진행 중인 AI 요청이 너무 많습니다. 잠시 후 다시 시도해주세요.")
+            
+            self.in_flight_users[user] += 1
+            if novel_id is not None:
+                self.in_flight_novels[novel_id] += 1
+            
+            if not self._is_next(ticket):
+                queued = sum(1 for t in self.waiting if t.priority == priority)
+                if not blocking or queued >= AI_QUEUE_LIMITS.get(priority, 0):
+                    self._leave(ticket)
+                    raise AIOverloaded("AI 요청이 많아 처리할 수 없습니다. 잠시 후 다시 시도해주세요.", retry_after=max(1, len(self.waiting)))
+                
+                self.waiting.append(ticket)
+                while not self._is_next(ticket):
+                    remaining = wait_until - time.time()
+                    if remaining <= 0:
+                        self.waiting.remove(ticket)
+                        self._leave(ticket)
+                        raise AIOverloaded("AI 요청 대기 시간이 초과되었습니다. 잠시 후 다시 시도해주세요.")
+                    self.condition.wait(remaining)
+                self.waiting.remove(ticket)
+            
+            self.running[priority] += ticket.cost
+            self.condition.notify_all()
+        return ticket
+    
+    def release(self, ticket):
+        with self.condition:
+            self.running[ticket.priority] -= ticket.cost
+            self._leave(ticket)
+    
+    def status(self):
+        with self.condition:
+            return {
+                'running': dict(self.running),
+                'waiting': dict(Counter(t.priority for t in self.waiting)),
+            }
+
+AI_ADMISSION = AdmissionController()
+
+def current_ai_deadline():
+    # 입장 제어에서 정한 요청의 처리 시한 (요청 밖에서는 None)
+    return g.get('ai_deadline') if has_app_context() else None
+
+def _ai_call_timeout(deadline):
+    # 모델 호출 타임아웃: AI 설정 값과 요청 처리 시한 중 짧은 쪽
+    timeout = get_ai_settings()['timeout']
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+    return timeout
+
+def ai_admission(priority, cost=1):
+    """AI를 호출하는 라우트에 입장 제어를 적용합니다. cost 는 숫자 또는 요청을 보고 계산하는 함수입니다."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            now = time.time()
+            deadline = now + get_ai_settings()['timeout']
+            if priority == 'interactive':
+                deadline = min(deadline, now + AI_INTERACTIVE_DEADLINE)
+            try:
+                ticket = AI_ADMISSION.acquire(
+                    priority,
+                    user=request.remote_addr,
+                    novel_id=kwargs.get('novel_id'),
+                    cost=cost() if callable(cost) else cost,
+                    deadline=deadline
+                )
+            except AIOverloaded as e:
+                return ai_overloaded_response(e)
+            
+            g.ai_deadline = deadline
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                AI_ADMISSION.release(ticket)
+                raise
+            
+            # 스트리밍 응답은 전송이 끝날 때 자리를 반환
+            if response.is_streamed:
+                response.call_on_close(lambda: AI_ADMISSION.release(ticket))
+            else:
+                AI_ADMISSION.release(ticket)
+            return response
+        return wrapper
+    return decorator
+
+def ai_overloaded_response(error):
+    if request.accept_mimetypes.best == 'text/html':
+        response = make_response(render_template('busy.html', message=str(error), retry_after=error.retry_after), 429)
+    else:
+        response = make_response(jsonify({'error': str(error)}), 429)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25", background=False, deadline=None):
+    if deadline is None:
+        deadline = current_ai_deadline()
+    if background:
+        return _generate_ai_response(prompt, model_name, deadline)
+    
+    with _foreground_ai_call():
+        return _generate_ai_response(prompt, model_name, deadline)
+
+def stream_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25", deadline=None):
+    """응답을 조각 단위로 돌려주는 제너레이터. 유효하지 않은 키는 첫 조각을 받기 전에만 다른 키로 재시도합니다."""
+    with _foreground_ai_call():
+        for _ in range(max(1, len(get_api_keys()))):
+            api_key = get_next_api_key()
+            if not api_key:
+                raise RuntimeError("API 키가 설정되지 않았습니다. 설정 페이지에서 API 키를 입력해주세요.")
+            
+            timeout = _ai_call_timeout(deadline)
+            if timeout <= 0:
+                raise RuntimeError("Error generating AI response: 요청 처리 시한을 넘었습니다.")
+            
+            started = False
+            try:
+                model = _create_model(api_key, model_name)
+                for chunk in model.generate_content(prompt, stream=True, timeout=timeout):
+                    if deadline is not None and time.time() > deadline:
+                        raise TimeoutError("요청 처리 시한을 넘었습니다.")
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except Exception as e:
+                error_message = str(e)
+                print(f"스트리밍 API 오류 발생: {error_message}")
+                if not started and is_invalid_key_error(error_message):
+                    mark_api_key_invalid(api_key)
+                    print(f"유효하지 않은 API 키: {api_key[:4]}... - 다른 키로 재시도합니다.")
+                    continue
+                if not started and is_quota_error(error_message):
+                    mark_api_key_cooldown(api_key)
+                    if get_usable_api_keys():
+                        print(f"할당량 초과 API 키: {api_key[:4]}... - 다른 키로 재시도합니다.")
+                        continue
+                raise RuntimeError(f"Error generating AI response: {error_message}")
+        raise RuntimeError("Error generating AI response: 사용할 수 있는 API 키가 없습니다.")
+
+def is_ai_error(result):
+    # generate_ai_response 는 오류를 예외 대신 문자열로 반환하므로 저장 전에 확인
+    return not result or result.startswith("Error generating AI response") or result.startswith("API 키가 설정되지 않았습니다")
+
+# genai.configure 는 프로세스 전역 설정이므로 동시 요청 시 키가 섞이지 않도록 잠금
+GENAI_CONFIGURE_LOCK = threading.Lock()
+
+def _create_model(api_key, model_name):
+    genai = get_genai()
+    
+    # 안전 설정 구성 - 모든 검열 카테고리에 대해 최소 제한 설정
+    safety_settings = [
+        {
+            "category": "HARM_CATEGORY_HARASSMENT",
+            "threshold": "BLOCK_NONE"
+        },
+        {
+            "category": "HARM_CATEGORY_HATE_SPEECH",
+            "threshold": "BLOCK_NONE"
+        },
+        {
+            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+            "threshold": "BLOCK_NONE"
+        },
+        {
+            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+            "threshold": "BLOCK_NONE"
+        }
+    ]
+    
+    # AI 안전 설정 적용
+    ai_settings = get_ai_settings()
+    if ai_settings['safety_settings'] == "moderate":
+        safety_settings = None  # 기본 안전 설정 사용
+    
+    with GENAI_CONFIGURE_LOCK:
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            safety_settings=safety_settings,
+            generation_config={
+                "temperature": ai_settings['temperature'],
+                "top_p": ai_settings['top_p'],
+                "max_output_tokens": 8192,
+            }
+        )
+        # 방금 설정한 키의 클라이언트를 모델에 고정 (google-generativeai 0.3.x 는 첫 요청 때 전역 클라이언트를 가져감)
+        client_module = sys.modules.get('google.generativeai.client')
+        if client_module is not None and hasattr(model, '_client'):
+            model._client = client_module.get_default_generative_client()
+    return model
+
+def _generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25", deadline=None):
     try:
+        # 재시도하는 사이 요청 처리 시한이 지났다면 더 호출하지 않음
+        timeout = _ai_call_timeout(deadline)
+        if timeout <= 0:
+            return "Error generating AI response: 요청 처리 시한을 넘었습니다."
+        
         # 다음 API 키 가져오기
         api_key = get_next_api_key()
         if not api_key:
@@ -168,62 +765,36 @@ def generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25"):
         
         # 현재 요청에 대한 API 키 설정
         print(f"API 요청에 사용할 키: {api_key[:4]}...{api_key[-4:] if len(api_key) > 8 else ''}")
-        genai.configure(api_key=api_key)
-        
-        # 안전 설정 구성 - 모든 검열 카테고리에 대해 최소 제한 설정
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_NONE"
-            }
-        ]
-        
-        # AI 안전 설정 적용
-        if AI_SAFETY_SETTINGS == "moderate":
-            safety_settings = None  # 기본 안전 설정 사용
         
         try:
             # 모델 생성
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                safety_settings=safety_settings,
-                generation_config={
-                    "temperature": AI_TEMPERATURE,
-                    "top_p": AI_TOP_P,
-                    "max_output_tokens": 8192,
-                }
-            )
+            model = _create_model(api_key, model_name)
             
             # 응답 생성 (타임아웃 설정)
-            response = model.generate_content(prompt, timeout=AI_TIMEOUT)
+            response = model.generate_content(prompt, timeout=timeout)
             return response.text
         except Exception as e:
             error_message = str(e)
             print(f"API 오류 발생: {error_message}")
             
-            # API 키가 유효하지 않은 경우 해당 키를 유효하지 않은 목록에 추가
-            if "API_KEY_INVALID" in error_message or "API key not valid" in error_message:
-                INVALID_API_KEYS.add(api_key)
+            # API 키가 유효하지 않은 경우 해당 키를 유효하지 않은 목록에 추가 (모든 워커에 공유)
+            if is_invalid_key_error(error_message):
+                mark_api_key_invalid(api_key)
                 print(f"유효하지 않은 API 키: {api_key[:4]}... - 다른 키로 재시도합니다.")
                 
                 # 다른 API 키로 재시도
-                if len(GOOGLE_API_KEYS) > 1:
-                    return generate_ai_response(prompt, model_name)
+                if get_usable_api_keys():
+                    return _generate_ai_response(prompt, model_name, deadline)
+            
+            # 할당량 초과 시 해당 키를 잠시 쉬게 하고 다른 키로 재시도
+            if is_quota_error(error_message):
+                mark_api_key_cooldown(api_key)
+                if get_usable_api_keys():
+                    print(f"할당량 초과 API 키: {api_key[:4]}... - 다른 키로 재시도합니다.")
+                    return _generate_ai_response(prompt, model_name, deadline)
             
             # 타임아웃 오류 발생 시 재시도
-            if "504 Deadline Exceeded" in error_message or "timeout" in error_message.lower():
+            if ("504 Deadline Exceeded" in error_message or "timeout" in error_message.lower()) and _ai_call_timeout(deadline) > 0:
                 print("타임아웃 오류 발생, 스트리밍 모드로 재시도합니다.")
                 try:
                     # 스트리밍 모드로 시도 (일부 API에서 더 안정적)
@@ -239,13 +810,13 @@ def generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25"):
                     print(f"스트리밍 재시도 중 오류: {retry_error_message}")
                     
                     # API 키가 유효하지 않은 경우 해당 키를 유효하지 않은 목록에 추가
-                    if "API_KEY_INVALID" in retry_error_message or "API key not valid" in retry_error_message:
-                        INVALID_API_KEYS.add(api_key)
+                    if is_invalid_key_error(retry_error_message):
+                        mark_api_key_invalid(api_key)
                         print(f"유효하지 않은 API 키: {api_key[:4]}... - 다른 키로 재시도합니다.")
                         
                         # 다른 API 키로 재시도
-                        if len(GOOGLE_API_KEYS) > 1 and len(INVALID_API_KEYS) < len(GOOGLE_API_KEYS):
-                            return generate_ai_response(prompt, model_name)
+                        if get_usable_api_keys():
+                            return _generate_ai_response(prompt, model_name, deadline)
                     
                     return f"Error generating AI response after retry: {retry_error_message}"
         
@@ -255,21 +826,136 @@ def generate_ai_response(prompt, model_name="gemini-2.5-pro-preview-03-25"):
         print(f"일반 오류 발생: {error_message}")
         return f"Error generating AI response: {error_message}"
 
-def check_spelling(text, model_name="gemini-2.0-flash"):
-    prompt = f"""아래 텍스트의 맞춤법을 검사해주세요. 오류가 있다면 수정해서 전체 텍스트를 반환해주세요.
-    오류가 없다면 '맞춤법 오류 없음'이라고 답변해주세요.
+# 맞춤법 검사 설정 (문단 단위로 나누어 바뀐 문단만 병렬 검사)
+SPELLING_CHUNK_CHARS = int(os.getenv("SPELLING_CHUNK_CHARS", "2000"))  # 한 번의 요청에 넣을 최대 글자 수
+SPELLING_MAX_WORKERS = int(os.getenv("SPELLING_MAX_WORKERS", "4"))  # 동시 요청 수
+SPELLING_CACHE_SIZE = 5000  # 캐시할 문단 수
+
+# 맞춤법 검사 캐시: (모델, 문단 해시) -> [(원문, 수정안), ...]
+SPELLING_CACHE = OrderedDict()
+SPELLING_CACHE_LOCK = threading.Lock()
+
+def split_paragraphs(text):
+    # (시작 위치, 문단) 목록, 빈 줄은 제외
+    paragraphs = []
+    offset = 0
+    for line in text.split('\n'):
+        if line.strip():
+            paragraphs.append((offset, line))
+        offset += len(line) + 1
+    return paragraphs
+
+def _parse_json_array(result):
+    # 모델이 코드 블록이나 설명을 덧붙여도 JSON 배열 부분만 읽음
+    start = result.find('[')
+    end = result.rfind(']')
+    if start == -1 or end < start:
+        raise ValueError(f"JSON 배열을 찾을 수 없습니다: {result[:200]}")
+    return json.loads(result[start:end + 1])
+
+def _check_spelling_chunk(paragraphs, model_name, deadline=None):
+    numbered = "\n".join(f"[{idx}] {paragraph}" for idx, paragraph in enumerate(paragraphs, 1))
+    prompt = f"""아래는 소설의 문단 목록입니다. 각 문단에서 맞춤법과 띄어쓰기 오류를 찾아주세요.
+    다른 설명 없이 JSON 배열로만 답변해주세요. 각 항목은 {{"paragraph": 문단 번호, "original": "문단에 적힌 그대로의 틀린 부분", "suggestion": "수정안"}} 형식입니다.
+    틀린 부분은 문단에서 그대로 찾을 수 있도록 짧게 잘라주세요. 오류가 없다면 []로 답변해주세요.
     
-    텍스트:
-    {text}"""
+    {numbered}"""
     
-    return generate_ai_response(prompt, model_name)
+    result = generate_ai_response(prompt, model_name, deadline=deadline)
+    if is_ai_error(result):
+        raise RuntimeError(result)
+    
+    corrections = [[] for _ in paragraphs]
+    for item in _parse_json_array(result):
+        try:
+            idx = int(item.get('paragraph', 0)) - 1
+            original = str(item.get('original', ''))
+            suggestion = str(item.get('suggestion', ''))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        # 문단에 없는 원문이나 바뀐 게 없는 제안은 버림
+        if 0 <= idx < len(paragraphs) and original and original != suggestion and original in paragraphs[idx]:
+            corrections[idx].append((original, suggestion))
+    return corrections
+
+def check_spelling(text, model_name="gemini-2.0-flash"):
+    """문단별 교정 목록을 반환합니다. 이전에 검사한 문단은 캐시를 사용합니다."""
+    paragraphs = split_paragraphs(text)
+    
+    # 캐시에 없는 문단만 골라 요청 크기에 맞게 묶음
+    unchecked = []
+    seen = set()
+    with SPELLING_CACHE_LOCK:
+        for _, paragraph in paragraphs:
+            key = (model_name, content_hash(paragraph))
+            if key in SPELLING_CACHE:
+                SPELLING_CACHE.move_to_end(key)
+            elif key not in seen:
+                seen.add(key)
+                unchecked.append(paragraph)
+    
+    chunks = []
+    current, current_size = [], 0
+    for paragraph in unchecked:
+        if current and current_size + len(paragraph) > SPELLING_CHUNK_CHARS:
+            chunks.append(current)
+            current, current_size = [], 0
+        current.append(paragraph)
+        current_size += len(paragraph)
+    if current:
+        chunks.append(current)
+    
+    errors = []
+    if chunks:
+        deadline = current_ai_deadline()  # 작업 스레드에서는 요청 정보를 볼 수 없으므로 미리 꺼내 둠
+        with ThreadPoolExecutor(max_workers=max(1, min(SPELLING_MAX_WORKERS, len(chunks)))) as executor:
+            futures = {executor.submit(_check_spelling_chunk, chunk, model_name, deadline): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    chunk_corrections = future.result()
+                except Exception as e:
+                    print(f"맞춤법 검사 오류: {str(e)}")
+                    errors.append(str(e))
+                    continue
+                with SPELLING_CACHE_LOCK:
+                    for paragraph, corrections in zip(chunk, chunk_corrections):
+                        SPELLING_CACHE[(model_name, content_hash(paragraph))] = corrections
+                    while len(SPELLING_CACHE) > SPELLING_CACHE_SIZE:
+                        SPELLING_CACHE.popitem(last=False)
+    
+    # 문단 내 위치를 전체 텍스트 기준 위치로 변환
+    results = []
+    with SPELLING_CACHE_LOCK:
+        for start, paragraph in paragraphs:
+            search_from = 0
+            for original, suggestion in SPELLING_CACHE.get((model_name, content_hash(paragraph)), []):
+                position = paragraph.find(original, search_from)
+                if position == -1:
+                    position = paragraph.find(original)
+                if position == -1:
+                    continue
+                search_from = position + len(original)
+                results.append({
+                    'offset': start + position,
+                    'length': len(original),
+                    'original': original,
+                    'suggestion': suggestion
+                })
+    
+    return {
+        'corrections': results,
+        'paragraphs': len(paragraphs),
+        'checked': len(unchecked),
+        'errors': errors
+    }
 
-def generate_summary(text, model_name="gemini-2.0-flash"):
+def generate_summary(text, model_name="gemini-2.0-flash", background=False):
     prompt = f"""다음 소설 회차의 내용을 사건과 인물 중심으로 300자 이내로 요약해주세요. 개인적인 감상이나 평가는 포함하지 마세요.:
     
     {text}"""
     
-    return generate_ai_response(prompt, model_name)
+    return generate_ai_response(prompt, model_name, background=background)
 
 def generate_major_summary(chapters, model_name="gemini-2.5-pro-preview-03-25"):
     # 각 회차의 제목과 내용을 결합
@@ -286,6 +972,269 @@ def generate_major_summary(chapters, model_name="gemini-2.5-pro-preview-03-25"):
     
     return generate_ai_response(prompt, model_name)
 
+def content_hash(text):
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+def summary_is_stale(chapter):
+    # 요약이 없거나, 요약을 만든 이후 본문이 바뀐 경우
+    if not chapter.content:
+        return False
+    if not chapter.summary:
+        return True
+    return chapter.summary_hash is not None and chapter.summary_hash != content_hash(chapter.content)
+
+# 작품별 컨텍스트(설정집 + 캐릭터) 캐시: novel_id -> (서명, 텍스트)
+CONTEXT_PREFIX_CACHE = {}
+CONTEXT_PREFIX_LOCK = threading.Lock()
+
+def _context_signature(novel_id):
+    # 행 전체를 읽지 않고 변경 여부만 확인 (추가/삭제/수정/정렬 시 서명이 바뀜)
+    signature = []
+    for model in (Setting, Character):
+        row = db.session.query(func.count(model.id), func.sum(model.id), func.max(model.updated_at)).filter(model.novel_id == novel_id).one()
+        signature.append((row[0], row[1], str(row[2])))
+    return tuple(signature)
+
+def get_context_prefix(novel_id):
+    signature = _context_signature(novel_id)
+    with CONTEXT_PREFIX_LOCK:
+        cached = CONTEXT_PREFIX_CACHE.get(novel_id)
+    if cached and cached[0] == signature:
+        return cached[1]
+    
+    settings = Setting.query.filter_by(novel_id=novel_id).order_by(Setting.order).all()
+    characters = Character.query.filter_by(novel_id=novel_id).order_by(Character.order).all()
+    
+    prefix = ""
+    if settings:
+        prefix += "설정집:\n"
+        for setting in settings:
+            prefix += f"[{setting.title}]\n{setting.content}\n\n"
+    if characters:
+        prefix += "캐릭터:\n"
+        for character in characters:
+            prefix += f"[{character.name}]\n{character.description}\n\n"
+    
+    with CONTEXT_PREFIX_LOCK:
+        CONTEXT_PREFIX_CACHE[novel_id] = (signature, prefix)
+    return prefix
+
+# 회차 본문 묶음 스냅샷: 회차 ID, 제목, 본문 해시로 키를 만들고 이어 붙인 본문을 압축해 디스크에 저장.
+# 키에 본문 해시가 들어가므로 한 번 만든 스냅샷은 바뀌지 않고, 회차를 고치면 새 키가 됨
+CHAPTER_SNAPSHOT = os.getenv("CHAPTER_SNAPSHOT", "on")  # on / off
+CHAPTER_SNAPSHOT_MAX_FILES = int(os.getenv("CHAPTER_SNAPSHOT_MAX_FILES", "200"))  # 디스크에 남길 스냅샷 수 (오래 안 쓴 것부터 삭제)
+CHAPTER_SNAPSHOT_CACHE_SIZE = 20  # 메모리에 둘 스냅샷 수
+CHAPTER_SNAPSHOT_FORMAT = 1  # 본문 조립 형식이 바뀌면 올려서 예전 스냅샷을 무시
+CHAPTER_SNAPSHOT_CACHE = OrderedDict()
+CHAPTER_SNAPSHOT_LOCK = threading.Lock()
+
+def _build_chapter_range_text(chapters):
+    return "".join(f"[{chapter.title}]\n{chapter.content}\n\n" for chapter in chapters)
+
+def _chapter_snapshot_key(entries):
+    # entries: 순서대로 (회차 ID, 제목, 본문 해시)
+    digest = hashlib.sha1(f"v{CHAPTER_SNAPSHOT_FORMAT}".encode('utf-8'))
+    for chapter_id, title, text_hash in entries:
+        digest.update(f"\0{chapter_id}\0{title}\0{text_hash}".encode('utf-8'))
+    return digest.hexdigest()
+
+def _chapter_range_entries(chapter_ids):
+    # 본문은 읽지 않고 ID, 제목, 해시만 조회
+    rows = db.session.query(Chapter.id, Chapter.title, Chapter.content_hash).filter(Chapter.id.in_(chapter_ids)).order_by(Chapter.order).all()
+    missing = [row.id for row in rows if row.content_hash is None]
+    if missing:
+        # content_hash 컬럼이 생기기 전에 저장된 회차는 한 번만 계산해서 채움 (updated_at 은 그대로 유지)
+        for chapter_id, content in db.session.query(Chapter.id, Chapter.content).filter(Chapter.id.in_(missing)):
+            db.session.execute(update(Chapter).where(Chapter.id == chapter_id)
+                               .values(content_hash=content_hash(content), updated_at=Chapter.updated_at))
+        db.session.commit()
+        return _chapter_range_entries(chapter_ids)
+    return [tuple(row) for row in rows]
+
+def _read_chapter_snapshot(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            text = zlib.decompress(mapped).decode('utf-8')
+    os.utime(path)  # 최근 사용 시각 갱신
+    return text
+
+def _write_chapter_snapshot(path, text):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # 다른 워커가 쓰다 만 파일을 읽지 않도록 임시 파일에 쓴 뒤 교체
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(zlib.compress(text.encode('utf-8')))
+    os.replace(temp_path, path)
+    
+    snapshots = [entry for entry in os.scandir(directory) if entry.name.endswith('.zz')]
+    if len(snapshots) > CHAPTER_SNAPSHOT_MAX_FILES:
+        snapshots.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in snapshots[:len(snapshots) - CHAPTER_SNAPSHOT_MAX_FILES]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def _remember_chapter_snapshot(key, text):
+    with CHAPTER_SNAPSHOT_LOCK:
+        CHAPTER_SNAPSHOT_CACHE[key] = text
+        CHAPTER_SNAPSHOT_CACHE.move_to_end(key)
+        while len(CHAPTER_SNAPSHOT_CACHE) > CHAPTER_SNAPSHOT_CACHE_SIZE:
+            CHAPTER_SNAPSHOT_CACHE.popitem(last=False)
+
+def get_chapter_range_text(chapter_ids):
+    """선택한 회차 본문을 순서대로 이어 붙인 텍스트를 돌려줍니다. 같은 범위는 스냅샷을 재사용합니다."""
+    if CHAPTER_SNAPSHOT == "off":
+        return _build_chapter_range_text(Chapter.query.filter(Chapter.id.in_(chapter_ids)).order_by(Chapter.order).all())
+    
+    entries = _chapter_range_entries(chapter_ids)
+    if not entries:
+        return ""
+    key = _chapter_snapshot_key(entries)
+    with CHAPTER_SNAPSHOT_LOCK:
+        text = CHAPTER_SNAPSHOT_CACHE.get(key)
+        if text is not None:
+            CHAPTER_SNAPSHOT_CACHE.move_to_end(key)
+            return text
+    
+    snapshot_dir = app.config['CHAPTER_SNAPSHOT_DIR']
+    try:
+        text = _read_chapter_snapshot(os.path.join(snapshot_dir, key + '.zz'))
+    except (OSError, ValueError, zlib.error):
+        # 스냅샷이 없거나 손상됨: 본문을 읽어 새로 만듦 (읽는 사이 본문이 바뀌었을 수 있으므로 읽은 본문으로 키를 다시 계산)
+        chapters = (Chapter.query.filter(Chapter.id.in_(chapter_ids)).order_by(Chapter.order)
+                    .options(load_only(Chapter.title, Chapter.content)).all())
+        text = _build_chapter_range_text(chapters)
+        key = _chapter_snapshot_key([(chapter.id, chapter.title, content_hash(chapter.content)) for chapter in chapters])
+        try:
+            _write_chapter_snapshot(os.path.join(snapshot_dir, key + '.zz'), text)
+        except OSError as e:
+            print(f"회차 본문 스냅샷 저장 실패: {e}")
+    _remember_chapter_snapshot(key, text)
+    return text
+
+class SummaryScheduler:
+    """유휴 시간에 빠지거나 오래된 회차 요약과 컨텍스트를 미리 준비하는 백그라운드 작업자"""
+    
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.recent_calls = []
+        self.thread = threading.Thread(target=self._run, name="summary-scheduler", daemon=True)
+        self.thread.start()
+    
+    def enqueue_novel(self, novel_id):
+        self._enqueue(('novel', novel_id))
+    
+    def enqueue_chapter(self, chapter_id):
+        self._enqueue(('chapter', chapter_id))
+    
+    def _enqueue(self, job):
+        with self.lock:
+            if job in self.pending:
+                return
+            self.pending.add(job)
+        self.jobs.put(job)
+    
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            with self.lock:
+                self.pending.discard(job)
+            try:
+                with self.app.app_context():
+                    if job[0] == 'novel':
+                        self._warm_novel(job[1])
+                    else:
+                        chapter = db.session.get(Chapter, job[1])
+                        if chapter:
+                            self._summarize(chapter)
+            except Exception as e:
+                print(f"백그라운드 요약 오류: {str(e)}")
+    
+    def _warm_novel(self, novel_id):
+        # 컨텍스트를 먼저 준비한 뒤 최신 회차부터 요약
+        get_context_prefix(novel_id)
+        chapters = Chapter.query.filter_by(novel_id=novel_id).order_by(Chapter.order.desc()).limit(AI_BACKGROUND_WINDOW).all()
+        for chapter in chapters:
+            if not self._summarize(chapter):
+                break
+    
+    def _wait_for_idle(self):
+        # 사용자의 AI 요청이 진행 중이거나 방금 끝났다면 대기
+        while True:
+            with AI_ACTIVITY_LOCK:
+                idle = AI_FOREGROUND_ACTIVE == 0 and time.time() - AI_LAST_FOREGROUND_AT >= AI_BACKGROUND_IDLE_SECONDS
+            if idle:
+                return
+            time.sleep(0.5)
+    
+    def _admit(self):
+        # 입장 제어에 빈 자리가 있을 때만 실행 (사용자 요청을 대기열에서 밀어내지 않음)
+        while True:
+            self._wait_for_idle()
+            try:
+                return AI_ADMISSION.acquire('background', user='background', blocking=False)
+            except AIOverloaded:
+                time.sleep(1)
+    
+    def _wait_for_quota(self):
+        # 정상 API 키 수에 비례하는 분당 호출 한도 안에서만 사용
+        while True:
+            now = time.time()
+            self.recent_calls = [t for t in self.recent_calls if now - t < 60]
+            valid_key_count = max(1, len(get_usable_api_keys()))
+            if len(self.recent_calls) < valid_key_count * AI_BACKGROUND_CALLS_PER_KEY:
+                self.recent_calls.append(now)
+                return
+            time.sleep(1)
+    
+    def _summarize(self, chapter):
+        """요약이 필요 없거나 생성에 성공하면 True, 오류가 나면 False"""
+        if not summary_is_stale(chapter):
+            return True
+        
+        source_hash = content_hash(chapter.content)
+        source_content = chapter.content
+        chapter_id = chapter.id
+        db.session.rollback()  # 대기하는 동안 트랜잭션을 잡아두지 않음
+        
+        self._wait_for_quota()
+        ticket = self._admit()
+        try:
+            summary = generate_summary(source_content, background=True)
+        finally:
+            AI_ADMISSION.release(ticket)
+        if is_ai_error(summary):
+            print(f"백그라운드 요약 실패 (회차 {chapter_id}): {summary}")
+            return False
+        
+        # 요약하는 동안 본문이 다시 수정되었다면 저장하지 않음 (다음 저장 때 다시 예약됨)
+        chapter = db.session.get(Chapter, chapter_id)
+        if chapter is None or content_hash(chapter.content) != source_hash:
+            return True
+        chapter.summary = summary
+        chapter.summary_hash = source_hash
+        db.session.commit()
+        print(f"백그라운드 요약 완료: 회차 {chapter_id}")
+        return True
+
+SUMMARY_SCHEDULER = None
+SUMMARY_SCHEDULER_LOCK = threading.Lock()
+
+def get_summary_scheduler():
+    # 첫 사용 시 작업자 스레드 시작
+    global SUMMARY_SCHEDULER
+    if AI_BACKGROUND_SUMMARY != "on" or not get_api_keys():
+        return None
+    with SUMMARY_SCHEDULER_LOCK:
+        if SUMMARY_SCHEDULER is None:
+            SUMMARY_SCHEDULER = SummaryScheduler(app)
+    return SUMMARY_SCHEDULER
+
 # Routes
 @app.route('/')
 def index():
@@ -309,6 +1258,9 @@ def edit_novel(novel_id):
     characters = Character.query.filter_by(novel_id=novel_id).order_by(Character.order).all()
     settings = Setting.query.filter_by(novel_id=novel_id).order_by(Setting.order).all()
     major_summaries = MajorSummary.query.filter_by(novel_id=novel_id).all()
+    recent_responses = AIResponse.query.filter_by(novel_id=novel_id, candidate_group=None).options(
+        load_only(AIResponse.id, AIResponse.user_input, AIResponse.model_name, AIResponse.created_at)
+    ).order_by(AIResponse.created_at.desc()).limit(10).all()
     
     # 프롬프트 가져오기
     system_prompts = Prompt.query.filter_by(novel_id=novel_id, prompt_type='system').all()
@@ -320,6 +1272,11 @@ def edit_novel(novel_id):
     selected_top_prompt = session.get(f'novel_{novel_id}_top_prompt', None)
     selected_bottom_prompt = session.get(f'novel_{novel_id}_bottom_prompt', None)
     
+    # 작가가 곧 AI 보조 기능을 쓸 가능성이 높으므로 최신 회차 요약과 컨텍스트를 미리 준비
+    scheduler = get_summary_scheduler()
+    if scheduler:
+        scheduler.enqueue_novel(novel_id)
+    
     # 사용 가능한 모델 목록
     models = {
         'main': ['gemini-2.5-pro-preview-03-25', 'gemini-2.0-flash-thinking-exp-01-21'],
@@ -333,6 +1290,8 @@ def edit_novel(novel_id):
         characters=characters, 
         settings=settings,
         major_summaries=major_summaries,
+        recent_responses=recent_responses,
+        max_candidates=AI_MAX_CANDIDATES,
         system_prompts=system_prompts,
         top_prompts=top_prompts,
         bottom_prompts=bottom_prompts,
@@ -362,30 +1321,48 @@ def edit_chapter(novel_id, chapter_id):
     novel = Novel.query.get_or_404(novel_id)
     chapter = Chapter.query.get_or_404(chapter_id)
     models = get_available_models()
+    summary_stale = bool(chapter.summary) and summary_is_stale(chapter)
     
-    return render_template('edit_chapter.html', novel=novel, chapter=chapter, models=models)
+    return render_template('edit_chapter.html', novel=novel, chapter=chapter, models=models, summary_stale=summary_stale)
 
 @app.route('/novel/<int:novel_id>/chapter/<int:chapter_id>/save', methods=['POST'])
 def save_chapter(novel_id, chapter_id):
     chapter = Chapter.query.get_or_404(chapter_id)
+    
+    # 이전 버전에서 만든 요약은 해시가 없으므로 수정 전 본문 기준으로 기록
+    if chapter.summary and chapter.summary_hash is None:
+        chapter.summary_hash = content_hash(chapter.content)
+    
     chapter.title = request.form.get('title', chapter.title)
     chapter.content = request.form.get('content', chapter.content)
     
-    # Generate summary if content changed
-    if chapter.content and (not chapter.summary or 'regenerate_summary' in request.form):
+    scheduler = get_summary_scheduler()
+    if chapter.content and 'regenerate_summary' in request.form:
+        # 사용자가 직접 요청한 경우 즉시 생성
         assistant_model = request.form.get('assistant_model', 'gemini-2.0-flash')
         chapter.summary = generate_summary(chapter.content, assistant_model)
+        chapter.summary_hash = content_hash(chapter.content)
+    elif summary_is_stale(chapter):
+        if scheduler:
+            # 요약은 유휴 시간에 백그라운드에서 생성
+            db.session.commit()
+            scheduler.enqueue_chapter(chapter.id)
+        elif not chapter.summary:
+            assistant_model = request.form.get('assistant_model', 'gemini-2.0-flash')
+            chapter.summary = generate_summary(chapter.content, assistant_model)
+            chapter.summary_hash = content_hash(chapter.content)
     
     db.session.commit()
     return redirect(url_for('edit_chapter', novel_id=novel_id, chapter_id=chapter_id))
 
 @app.route('/novel/<int:novel_id>/chapter/<int:chapter_id>/check_spelling', methods=['POST'])
+@ai_admission('interactive')
 def check_chapter_spelling(novel_id, chapter_id):
     content = request.form.get('content', '')
     assistant_model = request.form.get('assistant_model', 'gemini-2.0-flash')
     
     result = check_spelling(content, assistant_model)
-    return jsonify({'result': result})
+    return jsonify(result)
 
 @app.route('/novel/<int:novel_id>/chapter/reorder', methods=['POST'])
 def reorder_chapters(novel_id):
@@ -494,46 +1471,28 @@ def edit_prompt(novel_id, prompt_id):
     db.session.commit()
     return redirect(url_for('edit_novel', novel_id=novel_id))
 
-@app.route('/novel/<int:novel_id>/ai_assist', methods=['POST'])
-def ai_assist(novel_id):
-    novel = Novel.query.get_or_404(novel_id)
-    
+def build_assist_prompt(novel_id, form):
+    """ai_assist 폼의 선택값으로 모델에 보낼 전체 프롬프트를 조립합니다."""
     # Get selected chapters for summaries
-    summary_chapter_ids = request.form.getlist('summary_chapters')
+    summary_chapter_ids = form.getlist('summary_chapters')
     summary_chapters = Chapter.query.filter(Chapter.id.in_(summary_chapter_ids)).order_by(Chapter.order).all()
     
     # Get selected chapters for content
-    content_chapter_ids = request.form.getlist('content_chapters')
-    content_chapters = Chapter.query.filter(Chapter.id.in_(content_chapter_ids)).order_by(Chapter.order).all()
+    content_chapter_ids = form.getlist('content_chapters')
     
     # Get selected major summaries
-    major_summary_ids = request.form.getlist('major_summaries')
+    major_summary_ids = form.getlist('major_summaries')
     major_summaries = MajorSummary.query.filter(MajorSummary.id.in_(major_summary_ids)).all()
     
-    # Get characters and settings in order
-    characters = Character.query.filter_by(novel_id=novel_id).order_by(Character.order).all()
-    settings = Setting.query.filter_by(novel_id=novel_id).order_by(Setting.order).all()
-    
     # Get prompts
-    system_prompt_id = request.form.get('system_prompt')
-    top_prompt_id = request.form.get('top_prompt')
-    bottom_prompt_id = request.form.get('bottom_prompt')
-    
-    # 선택된 프롬프트 세션에 저장
-    session[f'novel_{novel_id}_system_prompt'] = system_prompt_id
-    session[f'novel_{novel_id}_top_prompt'] = top_prompt_id
-    session[f'novel_{novel_id}_bottom_prompt'] = bottom_prompt_id
+    system_prompt_id = form.get('system_prompt')
+    top_prompt_id = form.get('top_prompt')
+    bottom_prompt_id = form.get('bottom_prompt')
     
     system_prompt = Prompt.query.get(system_prompt_id) if system_prompt_id else None
     top_prompt = Prompt.query.get(top_prompt_id) if top_prompt_id else None
     bottom_prompt = Prompt.query.get(bottom_prompt_id) if bottom_prompt_id else None
     
-    # User input
-    user_input = request.form.get('user_input', '')
-    
-    # Selected model
-    main_model = request.form.get('main_model', 'gemini-2.5-pro-preview-03-25')
-    
     # Build the prompt
     full_prompt = ""
     
@@ -545,17 +1504,8 @@ def ai_assist(novel_id):
     if top_prompt:
         full_prompt += f"{top_prompt.content}\n\n"
     
-    # 3. Settings
-    if settings:
-        full_prompt += "설정집:\n"
-        for setting in settings:
-            full_prompt += f"[{setting.title}]\n{setting.content}\n\n"
-    
-    # 4. Characters
-    if characters:
-        full_prompt += "캐릭터:\n"
-        for character in characters:
-            full_prompt += f"[{character.name}]\n{character.description}\n\n"
+    # 3-4. Settings and characters (미리 준비된 컨텍스트 재사용)
+    full_prompt += get_context_prefix(novel_id)
     
     # 5. Major summaries (대요약본)
     if major_summaries:
@@ -570,31 +1520,306 @@ def ai_assist(novel_id):
             if chapter.summary:
                 full_prompt += f"[{chapter.title}] 요약: {chapter.summary}\n\n"
     
-    # 7. Chapter contents
-    if content_chapters:
-        full_prompt += "회차 본문:\n"
-        for chapter in content_chapters:
-            full_prompt += f"[{chapter.title}]\n{chapter.content}\n\n"
+    # 7. Chapter contents (같은 범위는 미리 이어 붙여 둔 스냅샷 재사용)
+    if content_chapter_ids:
+        chapter_text = get_chapter_range_text(content_chapter_ids)
+        if chapter_text:
+            full_prompt += "회차 본문:\n" + chapter_text
     
     # 8. User input (main prompt)
-    full_prompt += f"메인 프롬프트:\n{user_input}\n\n"
+    full_prompt += f"메인 프롬프트:\n{form.get('user_input', '')}\n\n"
     
     # 9. Bottom prompt
     if bottom_prompt:
         full_prompt += f"{bottom_prompt.content}"
     
+    return full_prompt
+
+def _token_stats(query, model, text_attr, token_attr, title_attr):
+    """본문은 읽지 않고 (행, 글자 수, 토큰 수) 목록을 돌려줍니다. 글자 수는 DB에서, 토큰 수는 저장된 값을 사용합니다."""
+    rows = (query.with_entities(model, func.coalesce(func.length(getattr(model, text_attr)), 0))
+            .options(load_only(getattr(model, token_attr), getattr(model, title_attr)))
+            .all())
+    stats = []
+    for row, chars in rows:
+        tokens = getattr(row, token_attr)
+        if tokens is None:
+            # 토큰 수 컬럼이 생기기 전에 저장된 행은 한 번만 계산해서 채움 (updated_at 은 그대로 유지)
+            tokens = estimate_tokens(getattr(row, text_attr))
+            db.session.execute(update(model).where(model.id == row.id)
+                               .values({token_attr: tokens, 'updated_at': model.updated_at}))
+        stats.append((row, chars, tokens))
+    return stats
+
+def _preview_items(stats, title_attr, template="[{}]\n\n\n"):
+    # template 은 본문을 감싸는 부분 (build_assist_prompt 와 같은 형식)
+    items = []
+    for row, chars, tokens in stats:
+        title = getattr(row, title_attr)
+        wrapper = template.format(title)
+        items.append({'id': row.id, 'title': title, 'chars': chars + len(wrapper), 'tokens': tokens + estimate_tokens(wrapper)})
+    return items
+
+def _preview_section(key, label, header='', items=()):
+    items = list(items)
+    return {
+        'key': key,
+        'label': label,
+        'chars': len(header) + sum(item['chars'] for item in items),
+        'tokens': estimate_tokens(header) + sum(item['tokens'] for item in items),
+        'items': items,
+    }
+
+def build_prompt_preview(novel_id, form):
+    """build_assist_prompt 와 같은 선택값으로 구간별 글자 수와 예상 토큰 수를 계산합니다. (모델 호출 없음)"""
+    sections = []
+    
+    system_prompt_id = form.get('system_prompt')
+    top_prompt_id = form.get('top_prompt')
+    bottom_prompt_id = form.get('bottom_prompt')
+    
+    system_prompt = Prompt.query.get(system_prompt_id) if system_prompt_id else None
+    top_prompt = Prompt.query.get(top_prompt_id) if top_prompt_id else None
+    bottom_prompt = Prompt.query.get(bottom_prompt_id) if bottom_prompt_id else None
+    
+    # 1-2. System instruction, top prompt
+    if system_prompt:
+        sections.append(_preview_section('system_prompt', '시스템 프롬프트', f"시스템 지시사항:\n{system_prompt.content}\n\n"))
+    if top_prompt:
+        sections.append(_preview_section('top_prompt', '상단 프롬프트', f"{top_prompt.content}\n\n"))
+    
+    # 3-4. Settings and characters
+    settings = _token_stats(Setting.query.filter_by(novel_id=novel_id).order_by(Setting.order), Setting, 'content', 'content_tokens', 'title')
+    if settings:
+        sections.append(_preview_section('settings', '설정집', "설정집:\n", _preview_items(settings, 'title')))
+    characters = _token_stats(Character.query.filter_by(novel_id=novel_id).order_by(Character.order), Character, 'description', 'description_tokens', 'name')
+    if characters:
+        sections.append(_preview_section('characters', '캐릭터', "캐릭터:\n", _preview_items(characters, 'name')))
+    
+    # 5. Major summaries
+    major_summary_ids = form.getlist('major_summaries')
+    if major_summary_ids:
+        major_summaries = _token_stats(MajorSummary.query.filter(MajorSummary.id.in_(major_summary_ids)), MajorSummary, 'content', 'content_tokens', 'title')
+        if major_summaries:
+            sections.append(_preview_section('major_summaries', '대요약본', "대요약본 (여러 회차의 종합 요약):\n", _preview_items(major_summaries, 'title')))
+    
+    # 6. Chapter summaries (요약이 없는 회차는 프롬프트에 들어가지 않음)
+    summary_chapter_ids = form.getlist('summary_chapters')
+    if summary_chapter_ids:
+        summary_chapters = _token_stats(Chapter.query.filter(Chapter.id.in_(summary_chapter_ids)).order_by(Chapter.order), Chapter, 'summary', 'summary_tokens', 'title')
+        if summary_chapters:
+            with_summary = [stat for stat in summary_chapters if stat[1]]
+            sections.append(_preview_section('summary_chapters', '회차 요약', "회차 요약:\n", _preview_items(with_summary, 'title', "[{}] 요약: \n\n")))
+    
+    # 7. Chapter contents
+    content_chapter_ids = form.getlist('content_chapters')
+    if content_chapter_ids:
+        content_chapters = _token_stats(Chapter.query.filter(Chapter.id.in_(content_chapter_ids)).order_by(Chapter.order), Chapter, 'content', 'content_tokens', 'title')
+        if content_chapters:
+            sections.append(_preview_section('content_chapters', '회차 본문', "회차 본문:\n", _preview_items(content_chapters, 'title')))
+    
+    # 8. User input
+    sections.append(_preview_section('user_input', '메인 프롬프트', f"메인 프롬프트:\n{form.get('user_input', '')}\n\n"))
+    
+    # 9. Bottom prompt
+    if bottom_prompt:
+        sections.append(_preview_section('bottom_prompt', '하단 프롬프트', f"{bottom_prompt.content}"))
+    
+    # 예전 행의 토큰 수를 채운 경우 저장
+    db.session.commit()
+    
+    total_tokens = sum(section['tokens'] for section in sections)
+    return {
+        'sections': sections,
+        'total_chars': sum(section['chars'] for section in sections),
+        'total_tokens': total_tokens,
+        'warn_tokens': AI_PROMPT_WARN_TOKENS,
+        'too_large': total_tokens > AI_PROMPT_WARN_TOKENS,
+    }
+
+def remember_prompt_selection(novel_id, form):
+    # 선택된 프롬프트 세션에 저장
+    session[f'novel_{novel_id}_system_prompt'] = form.get('system_prompt')
+    session[f'novel_{novel_id}_top_prompt'] = form.get('top_prompt')
+    session[f'novel_{novel_id}_bottom_prompt'] = form.get('bottom_prompt')
+
+@app.route('/novel/<int:novel_id>/ai_assist', methods=['POST'])
+@ai_admission('standard')
+def ai_assist(novel_id):
+    novel = Novel.query.get_or_404(novel_id)
+    remember_prompt_selection(novel_id, request.form)
+    
+    # User input
+    user_input = request.form.get('user_input', '')
+    
+    # Selected model
+    main_model = request.form.get('main_model', 'gemini-2.5-pro-preview-03-25')
+    
+    full_prompt = build_assist_prompt(novel_id, request.form)
+    
     # Generate AI response
     ai_response = generate_ai_response(full_prompt, main_model)
     
-    return render_template(
-        'ai_response.html', 
-        novel=novel, 
-        ai_response=ai_response, 
+    # 오류는 저장하지 않고 바로 보여줌
+    if is_ai_error(ai_response):
+        return render_template(
+            'ai_response.html', 
+            novel=novel, 
+            ai_response=ai_response, 
+            user_input=user_input
+        )
+    
+    # 응답을 저장하고 고유 주소로 이동 (새로고침해도 다시 생성하지 않음)
+    saved_response = save_ai_response(novel_id, user_input, ai_response, main_model)
+    return redirect(url_for('view_ai_response', novel_id=novel_id, response_id=saved_response.id))
+
+@app.route('/novel/<int:novel_id>/ai_assist/preview', methods=['POST'])
+def preview_assist_prompt(novel_id):
+    # ai_assist 와 같은 폼을 받아 프롬프트 크기만 계산 (생성 모델은 호출하지 않음)
+    Novel.query.get_or_404(novel_id)
+    return jsonify(build_prompt_preview(novel_id, request.form))
+
+def save_ai_response(novel_id, user_input, content, model_name, candidate_group=None):
+    response_hash = content_hash(content)
+    saved_response = AIResponse(
+        novel_id=novel_id,
         user_input=user_input,
-        markdown=markdown
+        content=content,
+        content_hash=response_hash,
+        html=render_markdown_cached(content, response_hash),
+        model_name=model_name,
+        candidate_group=candidate_group
+    )
+    db.session.add(saved_response)
+    db.session.commit()
+    return saved_response
+
+def get_ai_response_html(saved_response):
+    # 저장된 html 이 원문과 맞지 않을 때만 다시 렌더링
+    response_hash = content_hash(saved_response.content)
+    if saved_response.html is None or saved_response.content_hash != response_hash:
+        saved_response.html = render_markdown_cached(saved_response.content, response_hash)
+        saved_response.content_hash = response_hash
+        db.session.commit()
+    return saved_response.html
+
+@app.route('/novel/<int:novel_id>/ai_response/<int:response_id>')
+def view_ai_response(novel_id, response_id):
+    novel = Novel.query.get_or_404(novel_id)
+    saved_response = AIResponse.query.filter_by(id=response_id, novel_id=novel_id).first_or_404()
+    
+    return render_template(
+        'ai_response.html',
+        novel=novel,
+        ai_response=saved_response.content,
+        ai_response_html=get_ai_response_html(saved_response),
+        user_input=saved_response.user_input,
+        saved_response=saved_response
     )
 
+def _sse(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/novel/<int:novel_id>/ai_assist/candidates', methods=['POST'])
+@ai_admission('standard', cost=lambda: max(1, min(AI_MAX_CANDIDATES, request.form.get('candidate_count', 2, type=int))))
+def ai_assist_candidates(novel_id):
+    Novel.query.get_or_404(novel_id)
+    remember_prompt_selection(novel_id, request.form)
+    
+    user_input = request.form.get('user_input', '')
+    main_model = request.form.get('main_model', 'gemini-2.5-pro-preview-03-25')
+    candidate_count = max(1, min(AI_MAX_CANDIDATES, request.form.get('candidate_count', 2, type=int)))
+    full_prompt = build_assist_prompt(novel_id, request.form)
+    candidate_group = uuid.uuid4().hex
+    
+    # 하루 넘게 선택되지 않은 후보 정리
+    AIResponse.query.filter(
+        AIResponse.novel_id == novel_id,
+        AIResponse.candidate_group.isnot(None),
+        AIResponse.created_at < datetime.utcnow() - timedelta(days=1)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    
+    # 같은 프롬프트로 후보마다 별도 스레드에서 동시에 스트리밍 (API 키는 요청마다 순환)
+    events = queue.Queue()
+    cancelled = threading.Event()
+    deadline = current_ai_deadline()
+    
+    def worker(index):
+        try:
+            for chunk in stream_ai_response(full_prompt, main_model, deadline):
+                if cancelled.is_set():
+                    return
+                events.put((index, 'chunk', chunk))
+            events.put((index, 'done', None))
+        except Exception as e:
+            events.put((index, 'error', str(e)))
+    
+    for index in range(candidate_count):
+        threading.Thread(target=worker, args=(index,), daemon=True).start()
+    
+    def generate():
+        renderers = [IncrementalMarkdown() for _ in range(candidate_count)]
+        last_sent = [0.0] * candidate_count
+        remaining = candidate_count
+        try:
+            yield _sse({'candidates': candidate_count})
+            while remaining:
+                index, kind, payload = events.get()
+                if kind == 'chunk':
+                    html = renderers[index].feed(payload)
+                    # 후보마다 0.2초에 한 번만 전송
+                    now = time.time()
+                    if now - last_sent[index] >= 0.2:
+                        last_sent[index] = now
+                        yield _sse({'candidate': index, 'html': html})
+                    continue
+                
+                remaining -= 1
+                if kind == 'error' or not renderers[index].text:
+                    yield _sse({'candidate': index, 'error': payload or '빈 응답입니다.'})
+                    continue
+                saved_response = save_ai_response(novel_id, user_input, renderers[index].text, main_model, candidate_group)
+                yield _sse({
+                    'candidate': index,
+                    'done': True,
+                    'html': saved_response.html,
+                    'keep_url': url_for('keep_ai_response', novel_id=novel_id, response_id=saved_response.id)
+                })
+        finally:
+            cancelled.set()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/novel/<int:novel_id>/ai_response/<int:response_id>/keep', methods=['POST'])
+def keep_ai_response(novel_id, response_id):
+    saved_response = AIResponse.query.filter_by(id=response_id, novel_id=novel_id).first_or_404()
+    
+    # 선택한 후보만 남기고 같은 묶음의 나머지 후보는 삭제
+    if saved_response.candidate_group:
+        AIResponse.query.filter(
+            AIResponse.novel_id == novel_id,
+            AIResponse.candidate_group == saved_response.candidate_group,
+            AIResponse.id != saved_response.id
+        ).delete(synchronize_session=False)
+        saved_response.candidate_group = None
+        db.session.commit()
+    
+    return redirect(url_for('view_ai_response', novel_id=novel_id, response_id=response_id))
+
+@app.route('/novel/<int:novel_id>/ai_response/<int:response_id>/delete', methods=['POST'])
+def delete_ai_response(novel_id, response_id):
+    saved_response = AIResponse.query.filter_by(id=response_id, novel_id=novel_id).first_or_404()
+    db.session.delete(saved_response)
+    db.session.commit()
+    return redirect(url_for('edit_novel', novel_id=novel_id))
+
 @app.route('/api/chat', methods=['POST'])
+@ai_admission('interactive')
 def chat_api():
     user_message = request.json.get('message', '')
     model_name = request.json.get('model', 'gemini-2.0-flash')
@@ -675,6 +1900,7 @@ def delete_major_summary(novel_id, major_summary_id):
     return redirect(url_for('edit_novel', novel_id=novel_id))
 
 @app.route('/novel/<int:novel_id>/major_summary/generate', methods=['POST'])
+@ai_admission('batch')
 def generate_major_summary_route(novel_id):
     # 선택된 회차 ID 목록 가져오기
     chapter_ids = request.form.getlist('chapter_ids')
@@ -739,12 +1965,9 @@ def test_api_key():
         data = request.json
         api_keys_input = data.get('api_keys', '')
         
-        # API 키 목록 처리
-        api_keys_list = []
-        for key in api_keys_input.split(','):
-            key = key.strip()
-            if key:  # 빈 문자열이 아닌 경우에만 추가
-                api_keys_list.append(key)
+        # API 키 목록 처리 (마스킹된 기존 키는 실제 키로 되돌림)
+        masked_to_key = {mask_api_key(key): key for key in get_api_keys()}
+        api_keys_list = [masked_to_key.get(key, key) for key in parse_api_keys(api_keys_input)]
         
         if not api_keys_list:
             return jsonify({
@@ -755,6 +1978,7 @@ def test_api_key():
         # 각 API 키 테스트
         valid_keys = []
         invalid_keys = []
+        genai = get_genai()
         
         for i, api_key in enumerate(api_keys_list):
             try:
@@ -778,10 +2002,6 @@ def test_api_key():
         
         # 테스트 결과 반환
         if valid_keys:
-            # 테스트 후 원래 설정으로 복원
-            if GOOGLE_API_KEYS:
-                genai.configure(api_key=GOOGLE_API_KEYS[0])
-                
             return jsonify({
                 'success': True,
                 'message': f'{len(valid_keys)}개의 API 키가 유효합니다. {len(invalid_keys)}개의 API 키가 유효하지 않습니다.',
@@ -801,15 +2021,37 @@ def test_api_key():
         })
 
 # 애플리케이션 시작 시 데이터베이스 초기화
-with app.app_context():
-    db.create_all()
-    print("Database initialized successfully!")
+def upgrade_schema():
+    # create_all 은 기존 테이블에 새 컬럼을 추가하지 않으므로, 빠진 nullable 컬럼을 직접 추가
+    inspector = sa_inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                    print(f"컬럼 추가: {table.name}.{column.name}")
+
+def create_app(config=None):
+    """DB를 연결하고 스키마를 확인한 앱을 반환합니다. (예: gunicorn "app:create_app()")"""
+    if config:
+        app.config.update(config)
+    if 'sqlalchemy' not in app.extensions:
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            upgrade_schema()
+            init_shared_state()
+        print("Database initialized successfully!")
+        log_api_keys()
+    return app
 
 # AI 설정 변경 라우트
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
-    global AI_TIMEOUT, AI_SAFETY_SETTINGS, AI_TEMPERATURE, AI_TOP_P, GOOGLE_API_KEYS, CURRENT_API_KEY_INDEX, INVALID_API_KEYS
-    
     if request.method == 'POST':
         # 폼에서 설정 값 가져오기
         new_api_keys = request.form.get('api_key', '')
@@ -820,75 +2062,45 @@ def settings():
         
         # API 키 처리 (쉼표로 구분된 여러 키 지원)
         if new_api_keys:
-            # 쉼표로 구분된 API 키 목록을 배열로 변환 (공백 제거 및 빈 키 필터링)
-            new_api_keys_list = []
-            for key in new_api_keys.split(','):
-                key = key.strip()
-                if key:  # 빈 문자열이 아닌 경우에만 추가
-                    new_api_keys_list.append(key)
+            current_api_keys = get_api_keys()
+            # 화면에 마스킹되어 표시된 키가 그대로 제출되면 기존 키로 되돌림
+            masked_to_key = {mask_api_key(key): key for key in current_api_keys}
+            new_api_keys_list = [masked_to_key.get(key, key) for key in parse_api_keys(new_api_keys)]
             
             print(f"새로운 API 키 목록: {len(new_api_keys_list)}개")
             for i, key in enumerate(new_api_keys_list):
                 print(f"  키 {i+1}: {key[:4]}...{key[-4:] if len(key) > 8 else ''} (길이: {len(key)})")
             
-            # 기존 API 키 목록과 다른 경우에만 업데이트
-            if new_api_keys_list != GOOGLE_API_KEYS:
-                # 환경 변수 설정 (쉼표로 구분된 문자열로 저장)
-                os.environ['GOOGLE_API_KEY'] = ','.join(new_api_keys_list)
-                print(f"환경 변수에 저장된 API 키: {os.environ['GOOGLE_API_KEY']}")
+            # 기존 API 키 목록과 다른 경우에만 업데이트 (키 순환 위치와 유효하지 않은 키 목록도 초기화)
+            if new_api_keys_list != current_api_keys:
+                set_api_keys(new_api_keys_list)
                 
-                # 전역 변수 업데이트
-                GOOGLE_API_KEYS = new_api_keys_list
-                # API 키 인덱스 초기화
-                CURRENT_API_KEY_INDEX = 0
-                # 유효하지 않은 API 키 목록 초기화
-                INVALID_API_KEYS.clear()
-                
-                if GOOGLE_API_KEYS:
-                    # 첫 번째 API 키로 초기 구성
-                    genai.configure(api_key=GOOGLE_API_KEYS[0])
-                    print(f"API 키 {len(GOOGLE_API_KEYS)}개로 업데이트 완료")
-                    flash(f'{len(GOOGLE_API_KEYS)}개의 Google API 키가 성공적으로 업데이트되었습니다.')
+                if new_api_keys_list:
+                    print(f"API 키 {len(new_api_keys_list)}개로 업데이트 완료")
+                    flash(f'{len(new_api_keys_list)}개의 Google API 키가 성공적으로 업데이트되었습니다.')
                 else:
                     flash('API 키가 설정되지 않았습니다.')
         
-        # 환경 변수 설정
-        os.environ['AI_TIMEOUT'] = new_timeout
-        os.environ['AI_SAFETY_SETTINGS'] = new_safety
-        os.environ['AI_TEMPERATURE'] = new_temperature
-        os.environ['AI_TOP_P'] = new_top_p
-        
-        # 전역 변수 업데이트
-        AI_TIMEOUT = int(new_timeout)
-        AI_SAFETY_SETTINGS = new_safety
-        AI_TEMPERATURE = float(new_temperature)
-        AI_TOP_P = float(new_top_p)
+        # 공유 저장소에 저장 (모든 워커에 반영)
+        update_ai_settings({
+            'timeout': int(new_timeout),
+            'safety_settings': new_safety,
+            'temperature': float(new_temperature),
+            'top_p': float(new_top_p),
+        })
         
         return redirect(url_for('settings'))
     
-    # API 키 목록을 쉼표로 구분된 문자열로 변환
-    api_keys_str = ", ".join(GOOGLE_API_KEYS) if GOOGLE_API_KEYS else ""
-    
     # API 키 마스킹 처리 (보안을 위해)
-    masked_api_keys = ""
-    if api_keys_str:
-        # 각 API 키에 대해 마스킹 처리
-        masked_keys = []
-        for key in GOOGLE_API_KEYS:
-            if len(key) > 8:
-                masked_key = key[:4] + '*' * (len(key) - 8) + key[-4:]
-            else:
-                masked_key = key
-            masked_keys.append(masked_key)
-        
-        masked_api_keys = ", ".join(masked_keys)
+    masked_api_keys = ", ".join(mask_api_key(key) for key in get_api_keys())
+    ai_settings = get_ai_settings()
     
     return render_template('settings.html', 
                           api_key=masked_api_keys,
-                          timeout=AI_TIMEOUT, 
-                          safety_settings=AI_SAFETY_SETTINGS,
-                          temperature=AI_TEMPERATURE,
-                          top_p=AI_TOP_P)
+                          timeout=ai_settings['timeout'], 
+                          safety_settings=ai_settings['safety_settings'],
+                          temperature=ai_settings['temperature'],
+                          top_p=ai_settings['top_p'])
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
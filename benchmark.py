@@ -0,0 +1,515 @@
+"""GeulMeok9 오프라인 벤치마크
+
+네트워크 없이 실행할 수 있도록 google.generativeai 를 가짜 Gemini 백엔드로 바꿔 끼우고,
+임시 SQLite DB에 합성 소설(수천 개의 회차, 수백 명의 캐릭터)을 만든 뒤
+주요 라우트의 처리량과 p50/p99 지연 시간을 측정합니다.
+
+사용 예:
+    python benchmark.py
+    python benchmark.py --chapters 3000 --characters 300 --iterations 30
+    python benchmark.py --latency 0.5 --chunk-delay 0.05 --error-rate 0.2 --errors 429,504,invalid
+    python benchmark.py --json bench_output.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+# 가짜 Gemini 백엔드 -------------------------------------------------------
+
+# 실제 google-generativeai 예외 메시지와 같은 문구를 사용해야 app.py의 재시도 로직이 동작합니다
+ERROR_MESSAGES = {
+    "429": "429 Resource has been exhausted (e.g. check quota).",
+    "504": "504 Deadline Exceeded",
+    "invalid": '400 API key not valid. Please pass a valid API key. [reason: "API_KEY_INVALID"]',
+}
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiBackend:
+    """지연 시간, 스트리밍 청크 간격, 오류 주입을 설정할 수 있는 가짜 Gemini 백엔드"""
+
+    def __init__(self, latency=0.0, chunk_delay=0.0, chunk_size=200, error_rate=0.0,
+                 error_kinds=("429", "504", "invalid"), response_chars=1200, seed=0):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.error_kinds = list(error_kinds)
+        self.response_chars = response_chars
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.api_key = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"calls": 0, "stream_calls": 0, "errors": 0, "prompt_chars": 0}
+
+    def _maybe_fail(self):
+        with self.lock:
+            fail = self.error_kinds and self.random.random() < self.error_rate
+            kind = self.random.choice(self.error_kinds) if fail else None
+            if fail:
+                self.stats["errors"] += 1
+        if kind:
+            raise Exception(ERROR_MESSAGES[kind])
+
+    def _response_text(self, prompt):
+        if "JSON 배열로만" in str(prompt):
+            # 맞춤법 검사 요청: 첫 번째 문단에 교정 하나를 돌려줌
+            return '```json\n[{"paragraph": 1, "original": "그친", "suggestion": "그친"}, {"paragraph": 1, "original": "새벽,", "suggestion": "새벽"}]\n```'
+        base = "그는 천천히 고개를 들었다. 창밖으로 비가 내리고 있었다. "
+        repeat = self.response_chars // len(base) + 1
+        return (base * repeat)[:self.response_chars]
+
+    def generate(self, prompt, stream=False, timeout=None):
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_chars"] += len(str(prompt))
+            if stream:
+                self.stats["stream_calls"] += 1
+        if timeout is not None and self.latency > timeout:
+            # 실제 클라이언트처럼 타임아웃이 지나면 504 로 실패
+            time.sleep(max(0, timeout))
+            raise Exception(ERROR_MESSAGES["504"])
+        if self.latency:
+            time.sleep(self.latency)
+        self._maybe_fail()
+        text = self._response_text(prompt)
+        if not stream:
+            return FakeResponse(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        for start in range(0, len(text), self.chunk_size):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield FakeChunk(text[start:start + self.chunk_size])
+
+
+def install_fake_genai(backend):
+    """sys.modules 에 가짜 google.generativeai 모듈을 등록합니다."""
+    fake = types.ModuleType("google.generativeai")
+
+    def configure(api_key=None, **kwargs):
+        backend.api_key = api_key
+
+    class GenerativeModel:
+        def __init__(self, model_name="gemini-2.0-flash", safety_settings=None, generation_config=None, tools=None):
+            self.model_name = model_name
+
+        def generate_content(self, contents, stream=False, **kwargs):
+            return backend.generate(contents, stream=stream, timeout=kwargs.get("timeout"))
+
+    fake.configure = configure
+    fake.GenerativeModel = GenerativeModel
+    fake.__version__ = "fake"
+
+    google_pkg = sys.modules.get("google")
+    if google_pkg is None:
+        google_pkg = types.ModuleType("google")
+        google_pkg.__path__ = []
+        sys.modules["google"] = google_pkg
+    google_pkg.generativeai = fake
+    sys.modules["google.generativeai"] = fake
+    return fake
+
+
+# 합성 데이터 --------------------------------------------------------------
+
+PARAGRAPH = ("비가 그친 새벽, 주인공은 낡은 검을 챙겨 성문을 나섰다. "
+             "동료들은 아직 잠들어 있었고, 바람은 차가웠다. 그는 어제의 전투를 떠올렸다.\n")
+
+
+def seed_database(app_module, chapters, characters, settings, chapter_chars, seed=0):
+    """합성 소설 하나를 생성하고 novel id를 반환합니다."""
+    rnd = random.Random(seed)
+    db = app_module.db
+    novel = app_module.Novel(title="벤치마크 소설")
+    db.session.add(novel)
+    db.session.commit()
+
+    repeat = chapter_chars // len(PARAGRAPH) + 1
+    body = (PARAGRAPH * repeat)[:chapter_chars]
+    db.session.add_all([
+        app_module.Chapter(
+            title=f"{i + 1}화",
+            content=body,
+            summary=f"{i + 1}화 요약: 주인공이 성문을 나서 새로운 여정을 시작한다.",
+            order=i,
+            novel_id=novel.id,
+        )
+        for i in range(chapters)
+    ])
+    db.session.add_all([
+        app_module.Character(
+            name=f"캐릭터 {i + 1}",
+            description=f"나이 {rnd.randint(15, 60)}세. 검술에 능하며 과묵한 성격이다.",
+            order=i,
+            novel_id=novel.id,
+        )
+        for i in range(characters)
+    ])
+    db.session.add_all([
+        app_module.Setting(
+            title=f"설정 {i + 1}",
+            content="대륙은 다섯 왕국으로 나뉘어 있으며 마법은 혈통으로만 계승된다.",
+            order=i,
+            novel_id=novel.id,
+        )
+        for i in range(settings)
+    ])
+    db.session.add_all([
+        app_module.Prompt(name="시스템", content="너는 웹소설 작가를 돕는 조수다.", prompt_type="system", novel_id=novel.id),
+        app_module.Prompt(name="상단", content="아래 자료를 참고하라.", prompt_type="top", novel_id=novel.id),
+        app_module.Prompt(name="하단", content="다음 회차를 5000자 분량으로 작성하라.", prompt_type="bottom", novel_id=novel.id),
+    ])
+    db.session.commit()
+    return novel.id
+
+
+# 측정 ---------------------------------------------------------------------
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def measure(name, func, iterations, warmup=1):
+    """func 를 반복 실행하고 지연 시간 통계를 반환합니다."""
+    for _ in range(warmup):
+        func()
+    timings = []
+    failures = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        try:
+            ok = func()
+        except Exception:
+            ok = False
+        timings.append(time.perf_counter() - t0)
+        if ok is False:
+            failures += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "name": name,
+        "iterations": iterations,
+        "failures": failures,
+        "throughput_per_sec": iterations / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "max_ms": max(timings) * 1000 if timings else 0.0,
+    }
+
+
+def run_benchmarks(args):
+    backend = FakeGeminiBackend(
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        chunk_size=args.chunk_size,
+        error_rate=args.error_rate,
+        error_kinds=[kind for kind in args.errors.split(",") if kind],
+        seed=args.seed,
+    )
+    install_fake_genai(backend)
+
+    workdir = tempfile.mkdtemp(prefix="geulmeok9-bench-")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ["CHAPTER_SNAPSHOT_DIR"] = os.path.join(workdir, "snapshots")
+    os.environ["GOOGLE_API_KEY"] = ",".join(f"fake-key-{i:02d}-0000000000" for i in range(args.keys))
+    # 백그라운드 요약 작업이 측정 중인 가짜 백엔드 호출 수에 섞이지 않도록 기본으로 끔
+    os.environ["AI_BACKGROUND_SUMMARY"] = "on" if args.background_summary else "off"
+
+    quiet = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(quiet):
+            import app as app_module
+
+        with contextlib.redirect_stdout(quiet):
+            flask_app = app_module.create_app({"TESTING": True})
+        client = flask_app.test_client()
+
+        with flask_app.app_context(), contextlib.redirect_stdout(quiet):
+            novel_id = seed_database(app_module, args.chapters, args.characters, args.settings,
+                                     args.chapter_chars, seed=args.seed)
+            chapter_ids = [c.id for c in app_module.Chapter.query.filter_by(novel_id=novel_id)
+                           .order_by(app_module.Chapter.order).all()]
+            prompt_ids = {p.prompt_type: p.id for p in app_module.Prompt.query.filter_by(novel_id=novel_id).all()}
+
+        results = []
+        rnd = random.Random(args.seed)
+
+        def edit_novel():
+            return client.get(f"/novel/{novel_id}/edit").status_code == 200
+
+        assist_form = {
+            "main_model": "gemini-2.5-pro-preview-03-25",
+            "system_prompt": str(prompt_ids["system"]),
+            "top_prompt": str(prompt_ids["top"]),
+            "bottom_prompt": str(prompt_ids["bottom"]),
+            "summary_chapters": [str(i) for i in chapter_ids[-args.summary_window:]],
+            "content_chapters": [str(i) for i in chapter_ids[-args.content_window:]],
+            "user_input": "주인공이 숲에서 옛 동료를 만나는 장면",
+        }
+
+        saved_responses = []
+
+        def ai_assist():
+            response = client.post(f"/novel/{novel_id}/ai_assist", data=assist_form)
+            if response.status_code == 302:
+                saved_responses.append(response.location)
+            return response.status_code == 302
+
+        def preview():
+            # 프롬프트 크기 미리보기 (저장된 토큰 수 사용, 모델 호출 없음)
+            response = client.post(f"/novel/{novel_id}/ai_assist/preview", data=assist_form)
+            return response.status_code == 200 and response.get_json()["total_tokens"] > 0
+
+        def candidates():
+            # 같은 프롬프트로 후보 3개를 동시에 스트리밍 (후보 하나의 생성 시간과 비슷해야 함)
+            form = dict(assist_form, candidate_count="3")
+            response = client.post(f"/novel/{novel_id}/ai_assist/candidates", data=form)
+            body = response.get_data(as_text=True)
+            response.close()  # WSGI 서버처럼 응답을 닫아야 입장 제어 자리가 반환됨
+            return response.status_code == 200 and body.count('"done": true') == 3
+
+        def reopen_response():
+            # 저장된 응답 다시 보기 (모델 호출 없이 DB 조회만)
+            if not saved_responses:
+                return False
+            return client.get(saved_responses[-1]).status_code == 200
+
+        def reorder():
+            order = list(chapter_ids)
+            rnd.shuffle(order)
+            payload = {"order": [{"id": cid, "order": idx} for idx, cid in enumerate(order)]}
+            return client.post(f"/novel/{novel_id}/chapter/reorder", json=payload).status_code == 200
+
+        save_content = (PARAGRAPH * (args.chapter_chars // len(PARAGRAPH) + 1))[:args.chapter_chars]
+
+        def save():
+            chapter_id = rnd.choice(chapter_ids)
+            response = client.post(f"/novel/{novel_id}/chapter/{chapter_id}/save",
+                                   data={"title": "수정된 회차", "content": save_content})
+            return response.status_code == 302
+
+        def summary():
+            with flask_app.app_context():
+                text = app_module.generate_summary(save_content)
+            return not text.startswith("Error generating AI response")
+
+        spelling_text = (PARAGRAPH * (args.spelling_chars // len(PARAGRAPH) + 1))[:args.spelling_chars]
+        spelling_lines = spelling_text.split("\n")
+        spelling_edits = [0]
+
+        def spelling():
+            # 매번 문단 하나만 수정된 상태로 검사 (변경량에 비례하는지 확인)
+            spelling_edits[0] += 1
+            lines = list(spelling_lines)
+            lines[spelling_edits[0] % len(lines)] += f" 수정 {spelling_edits[0]}"
+            response = client.post(f"/novel/{novel_id}/chapter/{chapter_ids[0]}/check_spelling",
+                                   data={"content": "\n".join(lines)})
+            return response.status_code == 200 and not response.get_json().get("errors")
+
+        load_stop = threading.Event()
+        load_threads = []
+
+        def start_load():
+            # 다른 사용자들이 ai_assist 와 대요약본 생성을 계속 보내는 상황 (거절되면 잠시 쉬고 다시 요청)
+            def loop(index):
+                load_client = flask_app.test_client()
+                environ = {"REMOTE_ADDR": f"10.0.0.{index + 1}"}
+                while not load_stop.is_set():
+                    if index % 4 == 0:
+                        response = load_client.post(f"/novel/{novel_id}/major_summary/generate",
+                                                    data={"chapter_ids": [str(i) for i in chapter_ids[:3]]},
+                                                    environ_base=environ)
+                    else:
+                        response = load_client.post(f"/novel/{novel_id}/ai_assist", data=assist_form, environ_base=environ)
+                    if response.status_code == 429:
+                        time.sleep(0.05)
+
+            load_stop.clear()
+            for index in range(args.load_clients):
+                thread = threading.Thread(target=loop, args=(index,), daemon=True)
+                thread.start()
+                load_threads.append(thread)
+
+        def stop_load():
+            if not load_threads:
+                return
+            load_stop.set()
+            for thread in load_threads:
+                thread.join()
+            load_threads.clear()
+
+        def chat_under_load():
+            # 입장 제어가 채팅 자리를 남겨 두므로 부하가 있어도 지연 시간이 모델 응답 시간 근처여야 함
+            if not load_threads:
+                start_load()
+                time.sleep(args.latency)
+            response = client.post("/api/chat", json={"message": "다음 장면 아이디어를 줘"})
+            return response.status_code == 200 and "response" in response.get_json()
+
+        # 프롬프트 조립 비용만 보기 위해 ai_assist 는 지연 없는 백엔드로 측정합니다
+        scenarios = [
+            ("edit_novel", edit_novel, False),
+            ("ai_assist (prompt assembly)", ai_assist, False),
+            ("ai_response (reopen)", reopen_response, False),
+            ("preview (prompt size)", preview, False),
+            ("candidates x3 (streaming)", candidates, True),
+            ("reorder", reorder, False),
+            ("save", save, False),
+            ("summary generation", summary, True),
+            ("spelling (one paragraph changed)", spelling, True),
+            ("chat (under load)", chat_under_load, True),
+        ]
+        only = set(args.only.split(",")) if args.only else None
+        for name, func, use_backend_profile in scenarios:
+            if only and name.split(" ")[0] not in only:
+                continue
+            saved = (backend.latency, backend.chunk_delay, backend.error_rate)
+            if not use_backend_profile:
+                backend.latency, backend.chunk_delay, backend.error_rate = 0.0, 0.0, 0.0
+            with contextlib.redirect_stdout(quiet):
+                for _ in range(args.warmup):
+                    func()
+                backend.reset_stats()
+                result = measure(name, func, args.iterations, warmup=0)
+                stop_load()
+            result["backend"] = dict(backend.stats)
+            backend.latency, backend.chunk_delay, backend.error_rate = saved
+            results.append(result)
+            quiet.seek(0)
+            quiet.truncate()
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "create_app": t2 - t1,
+                  "genai_loaded": "google.generativeai" in sys.modules,
+                  "markdown_loaded": "markdown" in sys.modules}))
+"""
+
+
+def measure_startup(args):
+    """새 프로세스에서 import app 과 create_app() 시간을 측정합니다."""
+    workdir = tempfile.mkdtemp(prefix="geulmeok9-startup-")
+    env = dict(os.environ)
+    env["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "startup.db")
+    env["GOOGLE_API_KEY"] = "fake-key-00-0000000000"
+    root = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    try:
+        for _ in range(args.startup_runs):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=root, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import_times = [s["import"] for s in samples]
+    total_times = [s["import"] + s["create_app"] for s in samples]
+    return {
+        "import_p50_ms": percentile(import_times, 50) * 1000,
+        "startup_p50_ms": percentile(total_times, 50) * 1000,
+        "startup_max_ms": max(total_times) * 1000,
+        "genai_loaded": any(s["genai_loaded"] for s in samples),
+        "markdown_loaded": any(s["markdown_loaded"] for s in samples),
+    }
+
+
+def print_startup(startup, budget_ms):
+    print(f"startup: import app p50 {startup['import_p50_ms']:.1f} ms, "
+          f"import + create_app() p50 {startup['startup_p50_ms']:.1f} ms (max {startup['startup_max_ms']:.1f} ms, "
+          f"budget {budget_ms:.0f} ms)")
+    if startup["genai_loaded"] or startup["markdown_loaded"]:
+        print("startup: 경고 - 시작 시 google.generativeai 또는 markdown 이 로드되었습니다")
+
+
+def print_results(results):
+    header = f"{'scenario':<34} {'iter':>5} {'fail':>5} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'ai calls':>9} {'injected':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['name']:<34} {r['iterations']:>5} {r['failures']:>5} {r['throughput_per_sec']:>9.1f} "
+              f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['max_ms']:>9.1f} {r['backend']['calls']:>9} {r['backend']['errors']:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GeulMeok9 오프라인 벤치마크 (가짜 Gemini 백엔드 사용)")
+    parser.add_argument("--chapters", type=int, default=2000, help="합성 회차 수")
+    parser.add_argument("--characters", type=int, default=300, help="합성 캐릭터 수")
+    parser.add_argument("--settings", type=int, default=50, help="합성 설정 수")
+    parser.add_argument("--chapter-chars", type=int, default=5000, help="회차당 본문 글자 수")
+    parser.add_argument("--summary-window", type=int, default=30, help="ai_assist 에 넣을 요약 회차 수")
+    parser.add_argument("--content-window", type=int, default=5, help="ai_assist 에 넣을 본문 회차 수")
+    parser.add_argument("--spelling-chars", type=int, default=20000, help="맞춤법 검사 시나리오의 본문 글자 수")
+    parser.add_argument("--iterations", type=int, default=20, help="시나리오별 반복 횟수")
+    parser.add_argument("--warmup", type=int, default=1, help="시나리오별 워밍업 횟수")
+    parser.add_argument("--keys", type=int, default=3, help="가짜 API 키 개수")
+    parser.add_argument("--latency", type=float, default=0.05, help="가짜 모델 응답 지연(초)")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="스트리밍 청크 간격(초)")
+    parser.add_argument("--chunk-size", type=int, default=200, help="스트리밍 청크 크기(글자)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="오류 주입 비율 (0~1)")
+    parser.add_argument("--errors", default="429,504,invalid", help="주입할 오류 종류 (429,504,invalid)")
+    parser.add_argument("--load-clients", type=int, default=12, help="chat (under load) 시나리오에서 동시에 요청을 보내는 다른 사용자 수")
+    parser.add_argument("--background-summary", action="store_true", help="백그라운드 요약 스케줄러를 켠 채로 측정")
+    parser.add_argument("--startup-runs", type=int, default=5, help="시작 시간 측정 횟수 (0이면 건너뜀)")
+    parser.add_argument("--startup-budget-ms", type=float, default=1000, help="import + create_app() 시간 한도 (p50, ms)")
+    parser.add_argument("--only", default="", help="실행할 시나리오 (예: edit_novel,save)")
+    parser.add_argument("--seed", type=int, default=0, help="난수 시드")
+    parser.add_argument("--json", dest="json_path", default="", help="결과를 JSON 파일로 저장")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    startup = measure_startup(args) if args.startup_runs > 0 else None
+    results = run_benchmarks(args)
+    print_results(results)
+    exit_code = 0
+    if startup:
+        print()
+        print_startup(startup, args.startup_budget_ms)
+        if startup["startup_p50_ms"] > args.startup_budget_ms or startup["genai_loaded"]:
+            exit_code = 1
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "startup": startup, "results": results}, f, ensure_ascii=False, indent=2)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())